@@ -0,0 +1,289 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from urllib.parse import urlsplit
+import httpx
+import metrics
+from cache import ResponseCache
+from session import AccountSession
+from config import (
+    HTTP_TIMEOUT, HTTP_CONNECT_TIMEOUT, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE,
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RECEIPT_CHUNK_SIZE,
+    UPSTREAM_RATE, UPSTREAM_BURST, USER_RATE, USER_BURST,
+    RETRY_ATTEMPTS, RETRY_BACKOFF, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT,
+)
+from policy import RateLimiter, CircuitBreaker, SingleFlight, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+# URL для получения кода и авторизации
+SMS_CODE_URL = "https://nvs.domopult.ru/api/tenants-registration/code"
+LOGIN_URL = "https://nvs.domopult.ru/api/tenants-registration/login"
+PERSONAL_ACCOUNT_URL = "https://nvs.domopult.ru/api/api/personal_account/payments/{personal_account_id}?query=&sort=&page=0&size=15"
+PAYMENTS_PAGE_URL = "https://nvs.domopult.ru/api/api/personal_account/payments/{personal_account_id}?query=&sort=&page={page}&size={size}"
+CLIENTS_CONFIGURATION_ITEMS_URL = "https://nvs.domopult.ru/api/api/clients/configuration-items"
+METERS_FOR_ITEM_URL = "https://nvs.domopult.ru/api/api/clients/meters/for-item/{configuration_item_id}"
+METER_URL = "https://nvs.domopult.ru/api/api/clients/meters/{meter_id}"
+METER_VALUES_URL = "https://nvs.domopult.ru/api/api/clients/meters/{meter_id}/values?withOptionalCheck=true"
+RECEIPT_URL = "https://nvs.domopult.ru/api/api/personal_account/receipts_by_period/{personal_account_id}?date={year}-{month}-01&serviceType=UTILITIES"
+
+
+class ApiError(Exception):
+    """Сетевая ошибка при обращении к domopult."""
+
+
+class CircuitOpenError(ApiError):
+    """domopult признан недоступным, запрос не отправлялся."""
+
+
+class CachedResponse:
+    # Минимальная копия httpx.Response, которую можно хранить в кеше
+    __slots__ = ('status_code', 'text', '_data')
+
+    def __init__(self, status_code: int, text: str, data=None):
+        self.status_code = status_code
+        self.text = text
+        self._data = data
+
+    def json(self):
+        if self._data is None:
+            self._data = json.loads(self.text)
+        return self._data
+
+
+# Кеш ответов на чтение, ключ владельца - токен пользователя
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+# Политика исходящих запросов: общий и пользовательский лимиты, предохранитель
+rate_limiter = RateLimiter(UPSTREAM_RATE, UPSTREAM_BURST, USER_RATE, USER_BURST)
+circuit_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+# Одинаковые одновременные GET-запросы одного пользователя выполняются один раз
+single_flight = SingleFlight()
+
+metrics.register_cache('response', response_cache)
+metrics.GaugeFunc('nvbq_upstream_coalesced_calls', 'Запросы к domopult, которые сейчас ждут несколько обработчиков', lambda: {(): len(single_flight)})
+metrics.GaugeFunc(
+    'nvbq_upstream_circuit_open', 'Разомкнут ли предохранитель запросов к domopult',
+    lambda: {(): 0 if circuit_breaker.state == CircuitBreaker.CLOSED else 1},
+)
+
+
+# Запросы, которые не уложились в дедлайн и дорабатывают в фоне
+_background_tasks = set()
+
+
+# Общий клиент с пулом keep-alive соединений, создается при старте бота
+_client: httpx.AsyncClient | None = None
+
+
+def init_client(transport: httpx.AsyncBaseTransport | None = None) -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            ),
+            transport=transport,
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def endpoint_label(url: str) -> str:
+    # Путь без числовых идентификаторов, чтобы у метрик было ограниченное число меток
+    path = urlsplit(url).path.removeprefix('/api/')
+    return '/'.join('{id}' if segment.isdigit() else segment for segment in path.split('/'))
+
+
+def _observe(method: str, url: str, started: float, status) -> None:
+    endpoint = endpoint_label(url)
+    metrics.UPSTREAM_LATENCY.observe(method, endpoint, value=time.perf_counter() - started)
+    metrics.UPSTREAM_RESPONSES.inc(method, endpoint, str(status))
+
+
+def auth_headers(auth_token: str) -> dict:
+    return {
+        'X-Auth-Tenant-Token': f'{auth_token}',
+        'Content-Type': 'application/json'
+    }
+
+
+async def _before_request(method: str, url: str, auth_token: str | None) -> None:
+    if not circuit_breaker.allow():
+        raise CircuitOpenError(f"{method} {url}: domopult временно недоступен")
+    await rate_limiter.acquire(auth_token)
+
+
+async def request(method: str, url: str, auth_token: str | None = None, timeout: float | None = None, **kwargs) -> httpx.Response:
+    client = init_client()
+    if auth_token is not None:
+        kwargs['headers'] = {**auth_headers(auth_token), **kwargs.get('headers', {})}
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+
+    # Повторяем только идемпотентные GET-запросы
+    attempts = max(RETRY_ATTEMPTS, 1) if method == 'GET' else 1
+    for attempt in range(attempts):
+        if attempt:
+            await asyncio.sleep(backoff_delay(attempt - 1, RETRY_BACKOFF))
+        await _before_request(method, url, auth_token)
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            _observe(method, url, started, type(e).__name__)
+            circuit_breaker.record_failure()
+            last_error = e
+            continue
+        _observe(method, url, started, response.status_code)
+        if response.status_code >= 500:
+            circuit_breaker.record_failure()
+            if attempt + 1 < attempts:
+                continue
+        else:
+            circuit_breaker.record_success()
+        return response
+    raise ApiError(f"{method} {url}: {last_error!r}") from last_error
+
+
+async def get_cached(endpoint: str, url: str, auth_token: str, force_refresh: bool = False, ttl: float | None = None,
+                     project=None) -> CachedResponse:
+    # ttl переопределяет время жизни записи для группы эндпоинтов;
+    # project(data, digest) превращает разобранный JSON в компактную модель
+    # до помещения в кеш, digest - хеш тела ответа
+    if not force_refresh:
+        cached = response_cache.get(auth_token, endpoint, url)
+        if cached is not None:
+            return cached
+    return await single_flight.do(('GET', url, auth_token), lambda: _fetch_and_cache(endpoint, url, auth_token, ttl, project))
+
+
+async def _fetch_and_cache(endpoint: str, url: str, auth_token: str, ttl: float | None = None, project=None) -> CachedResponse:
+    try:
+        response = await request('GET', url, auth_token)
+    except ApiError:
+        # Пока domopult недоступен, отдаем устаревшие данные, если они есть
+        stale = response_cache.get(auth_token, endpoint, url, allow_stale=True)
+        if stale is None:
+            raise
+        return stale
+    if response.status_code != 200:
+        if response.status_code >= 500:
+            stale = response_cache.get(auth_token, endpoint, url, allow_stale=True)
+            if stale is not None:
+                return stale
+        return CachedResponse(response.status_code, response.text)
+    data = response.json()
+    # Текст успешного ответа не нужен, в кеше остаются только разобранные данные
+    if project is not None:
+        data = project(data, hashlib.blake2b(response.content, digest_size=16).hexdigest())
+    result = CachedResponse(response.status_code, '', data)
+    response_cache.set(auth_token, endpoint, url, result, ttl)
+    return result
+
+
+def _finish_in_background(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Фоновый запрос завершился ошибкой: {task.exception()}")
+
+
+async def gather_until(deadline: float, *aws) -> list:
+    # Выполняет запросы параллельно с общим дедлайном (по часам цикла событий).
+    # Вместо упавших и не успевших запросов возвращается None; последние
+    # не отменяются, а дорабатывают в фоне и наполняют кеш ответов.
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    await asyncio.wait(tasks, timeout=max(deadline - loop.time(), 0))
+    results = []
+    for task in tasks:
+        if not task.done():
+            _background_tasks.add(task)
+            task.add_done_callback(_finish_in_background)
+            results.append(None)
+        elif task.cancelled() or task.exception() is not None:
+            if not task.cancelled():
+                logger.warning(f"Ошибка при запросе к domopult: {task.exception()}")
+            results.append(None)
+        else:
+            results.append(task.result())
+    return results
+
+
+async def request_sms_code(phone: str) -> httpx.Response:
+    return await request('POST', SMS_CODE_URL, json={"phone": phone})
+
+
+async def login(payload: dict) -> httpx.Response:
+    return await request('POST', LOGIN_URL, json=payload)
+
+
+async def get_configuration_items(auth_token: str, force_refresh: bool = False, ttl: float | None = None) -> CachedResponse:
+    return await get_cached('configuration_items', CLIENTS_CONFIGURATION_ITEMS_URL, auth_token, force_refresh, ttl)
+
+
+async def get_payments(auth_token: str, personal_account_id, force_refresh: bool = False, ttl: float | None = None) -> CachedResponse:
+    url = PERSONAL_ACCOUNT_URL.format(personal_account_id=personal_account_id)
+    return await get_cached('payments', url, auth_token, force_refresh, ttl, project=AccountSession)
+
+
+async def get_meters_for_item(auth_token: str, configuration_item_id, force_refresh: bool = False, ttl: float | None = None) -> CachedResponse:
+    url = METERS_FOR_ITEM_URL.format(configuration_item_id=configuration_item_id)
+    return await get_cached('meters', url, auth_token, force_refresh, ttl)
+
+
+async def get_payments_page(auth_token: str, personal_account_id, page: int, size: int) -> httpx.Response:
+    # Страницы истории не кешируются: они сразу сохраняются в локальную базу
+    url = PAYMENTS_PAGE_URL.format(personal_account_id=personal_account_id, page=page, size=size)
+    return await single_flight.do(('GET', url, auth_token), lambda: request('GET', url, auth_token))
+
+
+async def get_meter(auth_token: str, meter_id) -> httpx.Response:
+    url = METER_URL.format(meter_id=meter_id)
+    return await single_flight.do(('GET', url, auth_token), lambda: request('GET', url, auth_token))
+
+
+async def post_meter_values(auth_token: str, meter_id, payload: dict, idempotency_key: str | None = None) -> httpx.Response:
+    # Ключ позволяет domopult распознать повтор уже принятой передачи показаний
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else {}
+    response = await request('POST', METER_VALUES_URL.format(meter_id=meter_id), auth_token, json=payload, headers=headers)
+    if response.status_code == 200:
+        # Последние показания изменились, список счетчиков нужно перечитать
+        response_cache.invalidate(auth_token, 'meters')
+    return response
+
+
+async def download_receipt(auth_token: str, personal_account_id, year, month, fileobj) -> CachedResponse:
+    # Тело квитанции пишется в fileobj по частям, не накапливаясь в памяти
+    url = RECEIPT_URL.format(personal_account_id=personal_account_id, year=year, month=month)
+    client = init_client()
+    await _before_request('GET', url, auth_token)
+    started = time.perf_counter()
+    try:
+        async with client.stream('GET', url, headers=auth_headers(auth_token)) as response:
+            _observe('GET', url, started, response.status_code)
+            if response.status_code >= 500:
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
+            if response.status_code != 200:
+                await response.aread()
+                return CachedResponse(response.status_code, response.text)
+            async for chunk in response.aiter_bytes(RECEIPT_CHUNK_SIZE):
+                fileobj.write(chunk)
+            return CachedResponse(response.status_code, '')
+    except httpx.HTTPError as e:
+        _observe('GET', url, started, type(e).__name__)
+        circuit_breaker.record_failure()
+        raise ApiError(f"GET {url}: {e!r}") from e
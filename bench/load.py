@@ -0,0 +1,303 @@
+"""Нагрузочный тест бота.
+
+Тысячи синтетических пользователей одновременно проходят вход, главную
+страницу, скачивание квитанции и передачу показаний. Обновления попадают в
+приложение так же, как в работе бота:
+
+    queue    - напрямую в application.update_queue;
+    polling  - через getUpdates (заглушка Bot API отдает накопленные обновления);
+    webhook  - HTTP-запросами к встроенному серверу вебхука (HTTP-клиент
+               работает в том же процессе, его накладные расходы входят в результат).
+
+Для каждого состояния разговора выводятся перцентили задержки от отправки
+обновления до конца его обработки, а также задержка цикла событий и рост
+памяти процесса. Несколько значений --users через запятую запускаются
+ступенями подряд, новые пользователи на каждой ступени, что позволяет найти
+предел одного процесса.
+
+Запуск из корня репозитория:
+    python -m bench.load --users 1000,2000,5000 --mode webhook --no-rate-limit
+"""
+import argparse
+import asyncio
+import gc
+import os
+import random
+import resource
+import socket
+import tempfile
+import time
+import tracemalloc
+
+import httpx
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from bench.run import FIRST_USER_ID, phone_for, meter_id_for, percentile, format_ms, start_application, stop_application
+from bench.stubs import MockDomopult, FakeBotApi, UpdateFactory
+
+WEBHOOK_PATH = 'telegram'
+WEBHOOK_SECRET = 'bench-secret'
+# Группа обработчиков, которая выполняется после всех обработчиков бота
+DONE_GROUP = 1000
+
+
+# Шаги сценариев: (тип, данные, состояние разговора, в котором пользователь отправляет обновление)
+SCENARIOS = {
+    'login': lambda uid: [
+        ('m', '/start', 'start'), ('c', 'phone', 'CHOOSING_METHOD'),
+        ('m', phone_for(uid), 'PHONE'), ('m', '1234', 'SMS_CODE'),
+    ],
+    'dashboard': lambda uid: [('m', '/start', 'dashboard'), ('c', 'refresh', 'refresh')],
+    'receipt': lambda uid: [
+        ('c', 'download_receipt', 'download_receipt'), ('m', '2024', 'SELECT_YEAR'), ('m', '05', 'SELECT_MONTH'),
+    ],
+    'meter': lambda uid: [
+        ('c', 'counters', 'counters'), ('c', f'meter_{meter_id_for(uid)}', 'SELECT_METER'),
+        ('m', '102.125', 'INPUT_READING'),
+    ],
+}
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Вне Linux доступен только пиковый размер
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_mb(size: int) -> str:
+    return f"{size / 2 ** 20:.1f} МБ"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class LoopLagMonitor:
+    """Измеряет, насколько позже запланированного просыпается цикл событий."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def reset(self) -> list:
+        samples, self.samples = self.samples, []
+        return samples
+
+
+class Ingress:
+    """Доставляет обновления в приложение выбранным способом и ждет конца их обработки."""
+
+    def __init__(self, application, bot_api: FakeBotApi, mode: str):
+        self.application = application
+        self.bot_api = bot_api
+        self.mode = mode
+        self.failed = set()
+        self._pending = {}
+        self._client = None
+        self._url = None
+
+    async def _done(self, update: Update, context) -> None:
+        future = self._pending.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def _error(self, update, context) -> None:
+        if isinstance(update, Update):
+            self.failed.add(update.update_id)
+
+    async def start(self) -> None:
+        self.application.add_handler(TypeHandler(Update, self._done), group=DONE_GROUP)
+        self.application.add_error_handler(self._error)
+        if self.mode == 'polling':
+            await self.application.updater.start_polling(poll_interval=0, timeout=1)
+        elif self.mode == 'webhook':
+            port = free_port()
+            await self.application.updater.start_webhook(
+                listen='127.0.0.1', port=port, url_path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+            )
+            self._url = f'http://127.0.0.1:{port}/{WEBHOOK_PATH}'
+            self._client = httpx.AsyncClient(
+                headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+                limits=httpx.Limits(max_connections=200, max_keepalive_connections=200),
+                timeout=60,
+            )
+        await self.application.start()
+
+    async def stop(self) -> None:
+        if self.application.updater.running:
+            await self.application.updater.stop()
+        await self.application.stop()
+        if self._client is not None:
+            await self._client.aclose()
+
+    async def send(self, update: Update, timeout: float) -> bool:
+        """Возвращает True, если обновление обработано без исключений."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending[update.update_id] = future
+        try:
+            if self.mode == 'queue':
+                await self.application.update_queue.put(update)
+            elif self.mode == 'polling':
+                self.bot_api.push_update(update.to_dict())
+            else:
+                response = await self._client.post(self._url, json=update.to_dict())
+                response.raise_for_status()
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, httpx.HTTPError):
+            self._pending.pop(update.update_id, None)
+            return False
+        return update.update_id not in self.failed
+
+
+class Stage:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.updates = 0
+        self.users_failed = 0
+
+
+async def walk_user(ingress: Ingress, factory: UpdateFactory, stage: Stage, user_id: int, args) -> None:
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    for scenario in args.scenarios:
+        for kind, payload, state in SCENARIOS[scenario](user_id):
+            update = factory.message(user_id, payload) if kind == 'm' else factory.callback(user_id, payload)
+            started = time.perf_counter()
+            ok = await ingress.send(update, args.step_timeout)
+            stage.latencies.setdefault(state, []).append(time.perf_counter() - started)
+            stage.updates += 1
+            if not ok:
+                stage.errors[state] = stage.errors.get(state, 0) + 1
+                # Разговор пользователя сбился, остальные шаги не имеют смысла
+                stage.users_failed += 1
+                return
+            if args.think:
+                await asyncio.sleep(random.uniform(0.5, 1.5) * args.think)
+
+
+def print_stage(users: int, stage: Stage, elapsed: float, lag: list, rss_before: int, rss_after: int, application) -> None:
+    print(f"\nСтупень: {users} пользователей, {elapsed:.1f} с, {stage.updates / elapsed:.1f} обновлений/с, "
+          f"сорвалось сценариев: {stage.users_failed}")
+    print(f"{'состояние':24}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for state, latencies in stage.latencies.items():
+        print(
+            f"{state:24}{len(latencies):8d}{stage.errors.get(state, 0):8d}"
+            f"{format_ms(percentile(latencies, 50))} {format_ms(percentile(latencies, 95))} "
+            f"{format_ms(percentile(latencies, 99))} {format_ms(max(latencies, default=0))}"
+        )
+    print(f"Задержка цикла событий: p50 {format_ms(percentile(lag, 50)).strip()} мс, "
+          f"p99 {format_ms(percentile(lag, 99)).strip()} мс, max {format_ms(max(lag, default=0)).strip()} мс")
+    print(f"Память: {format_mb(rss_after)} ({rss_after - rss_before:+,d} байт за ступень), "
+          f"user_data: {len(application.user_data)}, chat_data: {len(application.chat_data)}")
+
+
+async def load_test(args) -> None:
+    domopult = MockDomopult(latency=args.latency, error_rate=args.error_rate, receipt_size=args.receipt_size)
+    bot_api = FakeBotApi(latency=args.bot_latency)
+    application, _ = await start_application(bot_api, domopult, args.no_rate_limit)
+    ingress = Ingress(application, bot_api, args.mode)
+    factory = UpdateFactory(application.bot)
+    monitor = LoopLagMonitor()
+
+    print(f"Режим: {args.mode}, сценарии: {', '.join(args.scenarios)}, задержка domopult: {args.latency * 1000:.0f} мс, "
+          f"пауза между шагами: {args.think:.1f} с, разгон: {args.ramp:.1f} с")
+    gc.collect()
+    rss_start = rss_bytes()
+    if args.tracemalloc:
+        tracemalloc.start()
+        snapshot_start = tracemalloc.take_snapshot()
+
+    summary = []
+    next_user = FIRST_USER_ID
+    await ingress.start()
+    monitor.start()
+    try:
+        for users in args.users:
+            stage = Stage()
+            gc.collect()
+            rss_before = rss_bytes()
+            monitor.reset()
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                walk_user(ingress, factory, stage, user_id, args) for user_id in range(next_user, next_user + users)
+            ))
+            elapsed = time.perf_counter() - started
+            next_user += users
+            gc.collect()
+            rss_after = rss_bytes()
+            lag = monitor.reset()
+            print_stage(users, stage, elapsed, lag, rss_before, rss_after, application)
+            all_latencies = [value for latencies in stage.latencies.values() for value in latencies]
+            summary.append((users, stage.updates / elapsed, percentile(all_latencies, 99), max(lag, default=0), rss_after))
+    finally:
+        await monitor.stop()
+        await ingress.stop()
+        await stop_application(application)
+
+    print(f"\nИтог (память в начале: {format_mb(rss_start)})")
+    print(f"{'пользователей':>14}{'обновлений/с':>14}{'p99 ms':>10}{'лаг max ms':>12}{'память':>14}")
+    for users, throughput, p99, lag_max, rss in summary:
+        print(f"{users:14d}{throughput:14.1f}{format_ms(p99)} {format_ms(lag_max):>11}{format_mb(rss):>14}")
+
+    if args.tracemalloc:
+        print("\nНаибольший прирост памяти по местам выделения:")
+        for stat in tracemalloc.take_snapshot().compare_to(snapshot_start, 'lineno')[:10]:
+            print(f"  {stat}")
+        tracemalloc.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный тест NVBQ')
+    parser.add_argument('--users', type=lambda value: [int(part) for part in value.split(',')], default=[1000],
+                        help='число пользователей; несколько значений через запятую запускаются ступенями')
+    parser.add_argument('--mode', choices=('queue', 'polling', 'webhook'), default='queue', help='способ доставки обновлений')
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIOS),
+                        help=f"сценарии через запятую, выполняются по порядку: {','.join(SCENARIOS)}")
+    parser.add_argument('--ramp', type=float, default=5.0, help='за сколько секунд стартуют все пользователи ступени')
+    parser.add_argument('--think', type=float, default=0.5, help='средняя пауза пользователя между шагами, секунды')
+    parser.add_argument('--latency', type=float, default=0.05, help='средняя задержка domopult, секунды')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля запросов к domopult, завершающихся ошибкой')
+    parser.add_argument('--bot-latency', type=float, default=0.0, help='задержка ответа Bot API, секунды')
+    parser.add_argument('--receipt-size', type=int, default=16 * 1024, help='размер квитанции, байты')
+    parser.add_argument('--step-timeout', type=float, default=60.0, help='сколько ждать обработки одного обновления, секунды')
+    parser.add_argument('--no-rate-limit', action='store_true', help='отключить ограничение частоты запросов к domopult')
+    parser.add_argument('--tracemalloc', action='store_true', help='показать места наибольшего прироста памяти')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+
+def run() -> None:
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        asyncio.run(load_test(args))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,189 @@
+"""Офлайн-бенчмарк бота.
+
+Поднимает настоящее приложение из main.py с локальными заменами domopult и
+Telegram Bot API и прогоняет через него сценарии разговоров от имени
+множества пользователей. Для каждого сценария выводит пропускную способность
+и перцентили задержки.
+
+Запуск из корня репозитория:
+    python -m bench.run --users 200 --concurrency 50 --latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import api  # noqa: E402
+import main  # noqa: E402
+from bench.stubs import MockDomopult, FakeBotApi, UpdateFactory  # noqa: E402
+from policy import RateLimiter  # noqa: E402
+
+FIRST_USER_ID = 100_000
+
+
+def phone_for(user_id: int) -> str:
+    return f"+7{9_000_000_000 + user_id}"
+
+
+def meter_id_for(user_id: int, index: int = 1) -> int:
+    return MockDomopult.user_for_token(f"token-{phone_for(user_id)}") * 10 + index
+
+
+def batch_readings_for(user_id: int) -> str:
+    user = MockDomopult.user_for_token(f"token-{phone_for(user_id)}")
+    return f"CW-{user}: 102.125\nHW-{user}: 56.0\nEL-{user}: 3121.0, 1.0, 2.0"
+
+
+# Сценарии: последовательность шагов ('m' - сообщение, 'c' - нажатие кнопки)
+FLOWS = {
+    'login': lambda uid: [('m', '/start'), ('c', 'phone'), ('m', phone_for(uid)), ('m', '1234')],
+    'dashboard': lambda uid: [('m', '/start')],
+    'refresh': lambda uid: [('c', 'refresh')],
+    'detailed': lambda uid: [('c', 'detailed_info'), ('c', 'start')],
+    'receipt': lambda uid: [('c', 'download_receipt'), ('m', '2024'), ('m', '05')],
+    'meter': lambda uid: [('c', 'counters'), ('c', f'meter_{meter_id_for(uid)}'), ('m', '102.125')],
+    'meter_electricity': lambda uid: [('c', 'counters'), ('c', f'meter_{meter_id_for(uid, 3)}'), ('m', '3121.0, 1.0, 2.0')],
+    'meter_batch': lambda uid: [('c', 'counters'), ('c', 'submit_all_meters'), ('m', batch_readings_for(uid))],
+}
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def format_ms(seconds: float) -> str:
+    return f"{seconds * 1000:9.1f}"
+
+
+def print_table(title: str, rows: list) -> None:
+    print(f"\n{title}")
+    print(f"{'':24}{'count':>8}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, latencies, errors, elapsed in rows:
+        rps = len(latencies) / elapsed if elapsed else 0.0
+        print(
+            f"{name:24}{len(latencies):8d}{errors:8d}{rps:9.1f}"
+            f"{format_ms(percentile(latencies, 50))} {format_ms(percentile(latencies, 95))} "
+            f"{format_ms(percentile(latencies, 99))} {format_ms(max(latencies, default=0))}"
+        )
+
+
+async def start_application(bot_api: FakeBotApi, domopult: MockDomopult, unlimited: bool):
+    # Метрики бенчмарку не нужны, а порт может быть занят запущенным ботом
+    main.METRICS_PORT = 0
+    api.init_client(domopult)
+    if unlimited:
+        api.rate_limiter = RateLimiter(1e9, 1e9, 1e9, 1e9)
+    application = main.build_application(bot_request=bot_api)
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(context.error)
+    application.add_error_handler(on_error)
+
+    await application.initialize()
+    await application.post_init(application)
+    return application, errors
+
+
+async def stop_application(application) -> None:
+    # Тот же порядок, что в run_polling: shutdown сохраняет данные, затем post_shutdown закрывает хранилища
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+
+async def run_flow(application, factory: UpdateFactory, errors: list, flow: str, users: list, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    flow_latencies, step_latencies = [], {}
+    failed = 0
+
+    async def walk(user_id: int):
+        nonlocal failed
+        async with semaphore:
+            errors_before = len(errors)
+            total = 0.0
+            for index, (kind, payload) in enumerate(FLOWS[flow](user_id)):
+                update = factory.message(user_id, payload) if kind == 'm' else factory.callback(user_id, payload)
+                started = time.perf_counter()
+                await application.process_update(update)
+                elapsed = time.perf_counter() - started
+                total += elapsed
+                step = f"{index}:{re.sub(r'[0-9]+', '#', payload)}"
+                step_latencies.setdefault(step, []).append(elapsed)
+            flow_latencies.append(total)
+            if len(errors) > errors_before:
+                failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(walk(user_id) for user_id in users))
+    return flow_latencies, step_latencies, failed, time.perf_counter() - started
+
+
+async def benchmark(args) -> None:
+    domopult = MockDomopult(latency=args.latency, error_rate=args.error_rate)
+    bot_api = FakeBotApi(latency=args.bot_latency)
+    application, errors = await start_application(bot_api, domopult, args.no_rate_limit)
+    factory = UpdateFactory(application.bot)
+    users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+
+    rows, step_rows = [], []
+    try:
+        for flow in args.flows:
+            flow_latencies, step_latencies, failed, elapsed = await run_flow(
+                application, factory, errors, flow, users, args.concurrency
+            )
+            rows.append((flow, flow_latencies, failed, elapsed))
+            for step, latencies in step_latencies.items():
+                step_rows.append((f"{flow}/{step}"[:23], latencies, 0, elapsed))
+    finally:
+        await stop_application(application)
+
+    print(
+        f"Пользователей: {args.users}, параллельно: {args.concurrency}, "
+        f"задержка domopult: {args.latency * 1000:.0f} мс, ошибки domopult: {args.error_rate:.0%}"
+    )
+    print_table('Сценарии (время всего сценария одного пользователя)', rows)
+    if args.steps:
+        print_table('Шаги', step_rows)
+    print(f"\nЗапросов к domopult: {domopult.requests}")
+    for endpoint, count in sorted(domopult.by_endpoint.items()):
+        print(f"  {endpoint}: {count}")
+    print(f"Вызовов Bot API: {bot_api.calls}")
+    print(f"Исключений в обработчиках: {len(errors)}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк NVBQ')
+    parser.add_argument('--users', type=int, default=200, help='число пользователей')
+    parser.add_argument('--concurrency', type=int, default=50, help='сколько пользователей проходят сценарий одновременно')
+    parser.add_argument('--latency', type=float, default=0.05, help='средняя задержка domopult, секунды')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля запросов к domopult, завершающихся ошибкой')
+    parser.add_argument('--bot-latency', type=float, default=0.0, help='задержка ответа Bot API, секунды')
+    parser.add_argument('--flows', type=lambda value: value.split(','), default=list(FLOWS), help=f"сценарии через запятую: {','.join(FLOWS)}")
+    parser.add_argument('--steps', action='store_true', help='показать задержки отдельных шагов')
+    parser.add_argument('--no-rate-limit', action='store_true', help='отключить ограничение частоты запросов к domopult')
+    args = parser.parse_args(argv)
+    unknown = set(args.flows) - set(FLOWS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+
+def run() -> None:
+    args = parse_args()
+    # База и кеш квитанций создаются во временном каталоге
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        asyncio.run(benchmark(args))
+
+
+if __name__ == '__main__':
+    run()
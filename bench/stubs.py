@@ -0,0 +1,190 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+import zlib
+import httpx
+from telegram import Update
+from telegram.request import BaseRequest
+
+
+class MockDomopult(httpx.AsyncBaseTransport):
+    """Локальная замена domopult для эндпоинтов, которые использует бот.
+
+    latency - средняя задержка ответа в секундах (с разбросом +-50%),
+    error_rate - доля запросов, завершающихся ответом 500 или обрывом соединения.
+    """
+
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0, receipt_size: int = 200 * 1024, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.receipt = b'%PDF-1.4\n' + b'0' * receipt_size
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.by_endpoint = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await request.aread()
+        path = request.url.path
+        endpoint = '/'.join('{id}' if part.isdigit() else part for part in path.split('/'))
+        self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if self.error_rate and self.random.random() < self.error_rate:
+            if self.random.random() < 0.5:
+                raise httpx.ConnectError('injected failure', request=request)
+            return httpx.Response(500, text='injected failure')
+        return self.route(request)
+
+    def route(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        token = request.headers.get('X-Auth-Tenant-Token')
+        if path.endswith('/tenants-registration/code'):
+            return httpx.Response(200, text='')
+        if path.endswith('/tenants-registration/login'):
+            body = json.loads(request.content)
+            return httpx.Response(200, text=f"token-{body.get('phone') or body.get('email')}")
+        if token is None:
+            return httpx.Response(401, text='Unauthorized')
+
+        user = self.user_for_token(token)
+        if path.endswith('/clients/configuration-items'):
+            return httpx.Response(200, json={'items': [{'id': user, 'personalAccount': {'id': user}}]})
+        if '/personal_account/payments/' in path:
+            return httpx.Response(200, json=self.payments(user, request.url.params))
+        if '/meters/for-item/' in path:
+            return httpx.Response(200, json=[{'meter': meter} for meter in self.meters(user)])
+        if path.endswith('/values'):
+            return httpx.Response(200, json={})
+        if '/clients/meters/' in path:
+            meter_id = int(path.rsplit('/', 1)[-1])
+            meter = next((m for m in self.meters(user) if m['id'] == meter_id), None)
+            return httpx.Response(200, json={'meter': meter}) if meter else httpx.Response(404, text='Not found')
+        if '/receipts_by_period/' in path:
+            # Квитанции за январь недоступны, чтобы проверить путь с ответом 400
+            if request.url.params.get('date', '').endswith('-01-01'):
+                return httpx.Response(400, text='Receipt is not available')
+            return httpx.Response(200, content=self.receipt, headers={'Content-Type': 'application/pdf'})
+        return httpx.Response(404, text='Not found')
+
+    @staticmethod
+    def user_for_token(token: str) -> int:
+        # Идентификаторы выводятся из токена, чтобы у каждого пользователя были свои данные
+        return zlib.crc32(token.encode()) % 1_000_000 + 1
+
+    @staticmethod
+    def meters(user: int) -> list:
+        return [
+            {'id': user * 10 + 1, 'type': 'ColdWater', 'number': f'CW-{user}', 'lastValue': {'total': {'displayValue': '101.500'}}},
+            {'id': user * 10 + 2, 'type': 'HotWater', 'number': f'HW-{user}', 'lastValue': {'total': {'displayValue': '55.250'}}},
+            {'id': user * 10 + 3, 'type': 'Electricity', 'number': f'EL-{user}', 'lastValue': {'total': {'displayValue': '3120.0'}}},
+        ]
+
+    @staticmethod
+    def payments(user: int, params) -> dict:
+        page = int(params.get('page', 0))
+        size = int(params.get('size', 15))
+        total = 40
+        personal_account = {
+            'id': user, 'number': f'{user:010d}', 'utilitiesBalance': -1234.56, 'repairsBalance': 0, 'isActive': True,
+            'configurationItem': {'id': user, 'address': {'location': f'ул. Тестовая, д. {user % 100}'}, 'ciGroups': []},
+        }
+        client = {'id': user, 'contact': {'name': 'Тест', 'phone': '+70000000000', 'emails': [{'email': 'test@example.com'}]}}
+        results = [
+            {
+                'id': user * 1000 + index, 'creationDate': f'2024-{index % 12 + 1:02d}-01T10:00:00Z', 'status': 'DONE',
+                'paymentType': 'CARD', 'serviceType': 'UTILITIES', 'balance': 0, 'paymentSum': 1000 + index,
+                'paymentInsurance': 0, 'paymentSumWithoutInsurance': 1000 + index,
+                'personalAccount': personal_account, 'client': client, 'loginMethods': [], 'debtorInfo': {},
+            }
+            for index in range(total - page * size - 1, max(total - (page + 1) * size, 0) - 1, -1)
+        ]
+        return {'results': results, 'totalElements': total}
+
+
+class FakeBotApi(BaseRequest):
+    """Замена Telegram Bot API: отвечает на методы, которые вызывает бот,
+    и считает вызовы по методам. Обновления, добавленные через push_update,
+    отдаются боту в ответ на getUpdates."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self.by_method = {}
+        self._message_ids = itertools.count(1_000_000)
+        self._updates = asyncio.Queue()
+
+    def push_update(self, data: dict) -> None:
+        self._updates.put_nowait(data)
+
+    async def _poll_updates(self, timeout: float, limit: int) -> list:
+        # Долгий опрос: ждем первое обновление не дольше timeout, остальные забираем без ожидания
+        try:
+            batch = [await asyncio.wait_for(self._updates.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while len(batch) < limit and not self._updates.empty():
+            batch.append(self._updates.get_nowait())
+        return batch
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        name = url.rsplit('/', 1)[-1]
+        if self.latency and name != 'getUpdates':
+            await asyncio.sleep(self.latency)
+        self.calls += 1
+        self.by_method[name] = self.by_method.get(name, 0) + 1
+        params = request_data.parameters if request_data is not None else {}
+        chat_id = params.get('chat_id')
+
+        if name == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'NVBQ', 'username': 'nvbq_bench_bot'}
+        elif name in ('sendMessage', 'editMessageText', 'sendDocument'):
+            result = {
+                'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id or 0, 'type': 'private'}, 'text': params.get('text', ''),
+            }
+            if name == 'sendDocument':
+                result['document'] = {'file_id': f"file-{result['message_id']}", 'file_unique_id': str(result['message_id'])}
+        elif name == 'getUpdates':
+            result = await self._poll_updates(float(params.get('timeout') or 0), int(params.get('limit') or 100))
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class UpdateFactory:
+    """Собирает обновления Telegram от имени пользователя бенчмарка."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    def message(self, user_id: int, text: str) -> Update:
+        message = {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), 'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': next(self._update_ids), 'message': message}, self.bot)
+
+    def callback(self, user_id: int, data: str) -> Update:
+        callback_query = {
+            'id': str(next(self._update_ids)), 'chat_instance': str(user_id), 'data': data, 'from': self._user(user_id),
+            'message': {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'text': '.'},
+        }
+        return Update.de_json({'update_id': next(self._update_ids), 'callback_query': callback_query}, self.bot)
@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from telegram.ext import ContextTypes
+import cluster
+import metrics
+from policy import RateLimiter
+from storage import SqliteStore
+from config import (
+    BROADCAST_RATE, BROADCAST_CHAT_RATE, BROADCAST_BATCH, BROADCAST_CONCURRENCY, CLUSTER_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_MESSAGES = metrics.Counter('nvbq_broadcast_messages_total', 'Сообщения рассылок по результату', ('result',))
+
+READING_REMINDER_TEXT = (
+    "📊 Напоминаем: пора передать показания счётчиков за этот месяц.\n"
+    "Откройте личный кабинет командой /start и нажмите «Счётчики»."
+)
+
+
+class BroadcastStore(SqliteStore):
+    """Рассылки и прогресс их отправки.
+
+    Получатели - все пользователи из user_tokens, они читаются страницами
+    по возрастанию telegram_id. Рассылка делится на shards частей по
+    telegram_id % shards - по числу процессов-обработчиков на момент
+    создания, - и для каждой части хранится курсор, последний обработанный
+    telegram_id, поэтому после перезапуска рассылка продолжается с того же
+    места, даже если число обработчиков изменилось.
+    """
+
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            text TEXT NOT NULL,
+            created_by INTEGER,
+            recipients INTEGER NOT NULL,
+            shards INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            cancelled_at REAL,
+            reported_at REAL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_progress (
+            broadcast_id INTEGER NOT NULL,
+            shard INTEGER NOT NULL,
+            cursor INTEGER NOT NULL,
+            sent INTEGER NOT NULL,
+            failed INTEGER NOT NULL,
+            blocked INTEGER NOT NULL,
+            finished_at REAL,
+            PRIMARY KEY (broadcast_id, shard)
+        ) WITHOUT ROWID
+        ''',
+    )
+
+    CREATE_SQL = '''
+        INSERT OR IGNORE INTO broadcasts (key, text, created_by, recipients, shards, created_at)
+        VALUES (?, ?, ?, (SELECT COUNT(*) FROM user_tokens), ?, ?)
+    '''
+    # Завершенные рассылки не начинаются заново, даже если появились новые номера обработчиков
+    UNFINISHED_SQL = 'SELECT id, shards FROM broadcasts WHERE cancelled_at IS NULL AND reported_at IS NULL'
+    START_SQL = '''
+        INSERT OR IGNORE INTO broadcast_progress (broadcast_id, shard, cursor, sent, failed, blocked)
+        VALUES (?, ?, 0, 0, 0, 0)
+    '''
+    PENDING_SQL = '''
+        SELECT b.id, b.text, b.shards, p.shard, p.cursor, p.sent, p.failed, p.blocked
+        FROM broadcasts b JOIN broadcast_progress p ON p.broadcast_id = b.id
+        WHERE p.shard % ? = ? AND p.finished_at IS NULL AND b.cancelled_at IS NULL
+        ORDER BY b.id, p.shard
+    '''
+    # Постраничное чтение по первичному ключу, без OFFSET и без загрузки всех строк
+    RECIPIENTS_SQL = '''
+        SELECT telegram_id FROM user_tokens
+        WHERE telegram_id > ? AND telegram_id % ? = ?
+        ORDER BY telegram_id
+        LIMIT ?
+    '''
+    SAVE_PROGRESS_SQL = '''
+        UPDATE broadcast_progress SET cursor = ?, sent = ?, failed = ?, blocked = ?, finished_at = ?
+        WHERE broadcast_id = ? AND shard = ?
+    '''
+    CANCELLED_SQL = 'SELECT cancelled_at IS NOT NULL FROM broadcasts WHERE id = ?'
+    CANCEL_SQL = 'UPDATE broadcasts SET cancelled_at = ? WHERE id = ? AND cancelled_at IS NULL'
+    # Отчет отправляет тот процесс, который закончил свою часть последним
+    MARK_REPORTED_SQL = '''
+        UPDATE broadcasts SET reported_at = ?
+        WHERE id = ? AND reported_at IS NULL AND shards <= (
+            SELECT COUNT(*) FROM broadcast_progress WHERE broadcast_id = ? AND finished_at IS NOT NULL
+        )
+    '''
+    SUMMARY_SQL = '''
+        SELECT b.id, b.created_by, b.recipients, b.created_at, b.cancelled_at, b.shards,
+               COALESCE(SUM(p.sent), 0), COALESCE(SUM(p.failed), 0), COALESCE(SUM(p.blocked), 0),
+               COUNT(p.finished_at), MAX(p.finished_at)
+        FROM broadcasts b LEFT JOIN broadcast_progress p ON p.broadcast_id = b.id
+        WHERE b.id = ?
+        GROUP BY b.id
+    '''
+    RECENT_SQL = 'SELECT id FROM broadcasts ORDER BY id DESC LIMIT ?'
+
+    def _sync_create(self, key: str, text: str, created_by, shards: int) -> int | None:
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(self.CREATE_SQL, (key, text, created_by, shards, time.time()))
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def _sync_pending(self, index: int, count: int) -> list:
+        # Части рассылки распределяются между текущими обработчиками по номеру части
+        conn = self._connect()
+        with conn:
+            conn.executemany(self.START_SQL, [
+                (broadcast_id, part)
+                for broadcast_id, shards in conn.execute(self.UNFINISHED_SQL).fetchall()
+                for part in range(index, shards, count)
+            ])
+        return conn.execute(self.PENDING_SQL, (count, index)).fetchall()
+
+    async def create(self, key: str, text: str, created_by=None, shards: int = 1) -> int | None:
+        # None - рассылка с таким ключом уже есть
+        return await self._run(self._sync_create, key, text, created_by, shards)
+
+    async def pending(self, shard: tuple | None = None) -> list:
+        # Незавершенные части рассылок этого процесса:
+        # (id, текст, частей, часть, курсор, отправлено, ошибок, заблокировали)
+        index, count = shard or (0, 1)
+        return await self._run(self._sync_pending, index, count)
+
+    async def recipients(self, after: int, limit: int, part: int, shards: int) -> list:
+        return [row[0] for row in await self.fetchall(self.RECIPIENTS_SQL, (after, shards, part, limit))]
+
+    async def save_progress(self, broadcast_id: int, part: int, cursor: int, counts: dict, finished: bool = False) -> None:
+        await self.execute(self.SAVE_PROGRESS_SQL, (
+            cursor, counts['sent'], counts['failed'], counts['blocked'], time.time() if finished else None,
+            broadcast_id, part,
+        ))
+
+    async def is_cancelled(self, broadcast_id: int) -> bool:
+        row = await self.fetchone(self.CANCELLED_SQL, (broadcast_id,))
+        return row is None or bool(row[0])
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        return await self.execute(self.CANCEL_SQL, (time.time(), broadcast_id)) > 0
+
+    async def mark_reported(self, broadcast_id: int) -> bool:
+        return await self.execute(self.MARK_REPORTED_SQL, (time.time(), broadcast_id, broadcast_id)) > 0
+
+    async def summary(self, broadcast_id: int) -> dict | None:
+        row = await self.fetchone(self.SUMMARY_SQL, (broadcast_id,))
+        if row is None:
+            return None
+        keys = (
+            'id', 'created_by', 'recipients', 'created_at', 'cancelled_at', 'shards',
+            'sent', 'failed', 'blocked', 'shards_finished', 'finished_at',
+        )
+        return dict(zip(keys, row))
+
+    async def recent(self, limit: int) -> list:
+        return [await self.summary(row[0]) for row in await self.fetchall(self.RECENT_SQL, (limit,))]
+
+
+broadcast_store = BroadcastStore()
+
+_running = asyncio.Lock()
+
+
+def format_summary(summary: dict) -> str:
+    processed = summary['sent'] + summary['failed'] + summary['blocked']
+    if summary['cancelled_at']:
+        state = 'отменена'
+    elif summary['shards_finished'] >= summary['shards']:
+        state = 'завершена'
+    else:
+        state = 'идет'
+    end = summary['finished_at'] if state == 'завершена' else (summary['cancelled_at'] or time.time())
+    elapsed = max(end - summary['created_at'], 1e-3)
+    return (
+        f"Рассылка #{summary['id']} {state}: обработано {processed} из {summary['recipients']}, "
+        f"доставлено {summary['sent']}, заблокировали бота {summary['blocked']}, ошибок {summary['failed']}; "
+        f"{elapsed:.0f} с, {summary['sent'] / elapsed:.1f} сообщений/с"
+    )
+
+
+class _Sender:
+    # Отправка с общим лимитом, лимитом на чат и паузой по RetryAfter для всех отправок сразу
+
+    def __init__(self, bot, rate: float):
+        self.bot = bot
+        # Запас не меньше одного сообщения, иначе при малой доле лимита бакет никогда не наберет токен
+        self.limiter = RateLimiter(rate, max(rate, 1), BROADCAST_CHAT_RATE, 1)
+        self._paused_until = 0.0
+
+    async def send(self, chat_id: int, text: str) -> str:
+        for _ in range(3):
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.limiter.acquire(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return 'sent'
+            except RetryAfter as e:
+                # Telegram просит подождать - останавливаем всю рассылку, а не один чат
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            except Forbidden:
+                return 'blocked'
+            except TelegramError as e:
+                logger.warning(f"Не удалось отправить сообщение рассылки в чат {chat_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+
+async def run_broadcast(application, broadcast) -> None:
+    """Отправляет часть рассылки, начиная с сохраненного курсора.
+
+    При остановке бота рассылка прерывается, не дожидаясь конца страницы:
+    application.stop() ждет завершения заданий, а рассылка может идти долго.
+    Начатые отправки дожидаются ответа, новые не начинаются, поэтому
+    курсор встает ровно за последним получателем, и при продолжении никому
+    не придет второе сообщение. Повториться могут только отправки, которые
+    шли в момент аварийного завершения процесса (не больше
+    BROADCAST_CONCURRENCY).
+    """
+    bot = application.bot
+    broadcast_id, text, shards, part, cursor, sent, failed, blocked = broadcast
+    _, count = cluster.shard or (0, 1)
+    # Лимит Telegram общий для бота, каждый процесс, отправляющий рассылку, получает свою долю
+    sender = _Sender(bot, BROADCAST_RATE / min(count, shards))
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    counts = {'sent': sent, 'failed': failed, 'blocked': blocked}
+    started, processed = time.monotonic(), 0
+
+    while True:
+        if not application.running:
+            return
+        if await broadcast_store.is_cancelled(broadcast_id):
+            logger.warning(f"Рассылка #{broadcast_id} отменена")
+            return
+        chat_ids = await broadcast_store.recipients(cursor, BROADCAST_BATCH, part, shards)
+        if not chat_ids:
+            break
+        done = [False] * len(chat_ids)
+
+        async def deliver(position: int, chat_id: int) -> None:
+            # Семафор пропускает отправки по порядку страницы, поэтому после остановки
+            # обработанные получатели всегда идут подряд с ее начала
+            async with semaphore:
+                if not application.running:
+                    return
+                result = await sender.send(chat_id, text)
+            counts[result] += 1
+            BROADCAST_MESSAGES.inc(result)
+            done[position] = True
+
+        try:
+            await asyncio.gather(*(deliver(position, chat_id) for position, chat_id in enumerate(chat_ids)))
+        finally:
+            # Курсор сдвигается только за непрерывно обработанными получателями:
+            # при остановке или ошибке посреди страницы никто не будет пропущен
+            completed = next((position for position, ok in enumerate(done) if not ok), len(done))
+            if completed:
+                cursor = chat_ids[completed - 1]
+                processed += completed
+            await asyncio.shield(broadcast_store.save_progress(broadcast_id, part, cursor, counts))
+
+    await broadcast_store.save_progress(broadcast_id, part, cursor, counts, finished=True)
+    elapsed = time.monotonic() - started
+    logger.warning(
+        f"Рассылка #{broadcast_id}, часть {part + 1}/{shards}: {processed} получателей за {elapsed:.0f} с "
+        f"({processed / max(elapsed, 1e-3):.1f} сообщений/с), итого {counts}"
+    )
+    if await broadcast_store.mark_reported(broadcast_id):
+        summary = await broadcast_store.summary(broadcast_id)
+        if summary['created_by'] is not None:
+            try:
+                await bot.send_message(chat_id=summary['created_by'], text=f"📣 {format_summary(summary)}")
+            except TelegramError as e:
+                logger.warning(f"Не удалось отправить отчет о рассылке #{broadcast_id}: {e}")
+
+
+async def start_broadcast(key: str, text: str, created_by=None) -> int | None:
+    # Все процессы-обработчики подхватят рассылку при следующей проверке
+    return await broadcast_store.create(key, text, created_by, CLUSTER_WORKERS or 1)
+
+
+async def broadcast_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if _running.locked():
+        return
+    async with _running:
+        for broadcast in await broadcast_store.pending(cluster.shard):
+            await run_broadcast(context.application, broadcast)
+
+
+async def reading_reminder_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Ключ по месяцу: рассылка создается один раз, сколько бы процессов и перезапусков ни было
+    key = f"reading-reminder-{datetime.now():%Y-%m}"
+    if await start_broadcast(key, READING_REMINDER_TEXT) is not None:
+        logger.warning(f"Создана рассылка {key}")
+    context.job_queue.run_once(broadcast_job, 0, name='broadcast_now')
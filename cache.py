@@ -0,0 +1,103 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Ограниченный LRU-кеш с временем жизни записей и счетчиками попаданий."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class ResponseCache:
+    """Кеш ответов API, разложенный по владельцам (токенам пользователей).
+
+    У каждой группы эндпоинтов свое время жизни. Просроченные записи не
+    удаляются сразу, чтобы их можно было отдать как устаревшие; память
+    ограничивается вытеснением наименее активных владельцев.
+    """
+
+    def __init__(self, maxsize: int, ttls: dict):
+        self.maxsize = maxsize
+        self.ttls = ttls
+        self.hits = 0
+        self.misses = 0
+        self._owners = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._owners)
+
+    def get(self, owner, endpoint, key, allow_stale: bool = False):
+        entry = self._owners.get(owner, {}).get((endpoint, key))
+        if entry is None or (not allow_stale and entry[0] <= time.monotonic()):
+            self.misses += 1
+            return None
+        self._owners.move_to_end(owner)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, owner, endpoint, key, value, ttl: float | None = None) -> None:
+        if ttl is None:
+            ttl = self.ttls[endpoint]
+        entries = self._owners.setdefault(owner, {})
+        entries[(endpoint, key)] = (time.monotonic() + ttl, value)
+        self._owners.move_to_end(owner)
+        while len(self._owners) > self.maxsize:
+            self._owners.popitem(last=False)
+
+    def invalidate(self, owner, *endpoints) -> None:
+        if not endpoints:
+            self._owners.pop(owner, None)
+            return
+        entries = self._owners.get(owner)
+        if entries:
+            for cache_key in [k for k in entries if k[0] in endpoints]:
+                del entries[cache_key]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
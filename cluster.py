@@ -0,0 +1,320 @@
+import asyncio
+import collections
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+from telegram import Bot, Update
+import api
+import metrics
+from policy import TokenBucket
+from config import (
+    TELEGRAM_TOKEN, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET,
+    METRICS_LISTEN, METRICS_PORT, UPSTREAM_RATE, UPSTREAM_BURST,
+    CLUSTER_WORKERS, CLUSTER_SOCKET_DIR, CLUSTER_ACK_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# (номер процесса-обработчика, число обработчиков); None - бот работает в одном процессе
+shard: tuple | None = None
+
+# Обновление передается обработчику кадром: длина тела и JSON обновления как его прислал Telegram.
+# Обработчик подтверждает каждый кадр одним байтом, когда обновление поставлено в очередь
+_HEADER = struct.Struct('>I')
+_ACK = b'\x01'
+
+INGRESS_UPDATES = metrics.Counter(
+    'nvbq_ingress_updates_total', 'Обновления, принятые приемником, по обработчикам и результату', ('worker', 'result'),
+)
+
+
+def owns(telegram_id) -> bool:
+    # Обрабатывает ли этот процесс пользователя telegram_id
+    if shard is None:
+        return True
+    index, count = shard
+    return telegram_id % count == index
+
+
+def socket_path(index: int) -> str:
+    return os.path.join(CLUSTER_SOCKET_DIR, f'worker-{index}.sock')
+
+
+def raw_update_owner(data) -> int | None:
+    # То же, что updates.update_owner, но по JSON обновления, без разбора в объекты PTB
+    if not isinstance(data, dict):
+        return None
+    for key, value in data.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if user is not None:
+            return user.get('id')
+        chat = value.get('chat') or value.get('message', {}).get('chat')
+        if chat is not None:
+            return chat.get('id')
+    return None
+
+
+# Процесс-обработчик
+
+class _UpdateServer:
+    """Сокет, через который обработчик получает обновления от приемника."""
+
+    def __init__(self, application, index: int):
+        self.application = application
+        self.path = socket_path(index)
+        self._server: asyncio.AbstractServer | None = None
+        self._connections = {}
+
+    async def start(self) -> None:
+        # Сокет мог остаться от прошлого запуска
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, self.path)
+
+    async def stop(self) -> None:
+        # Закрываем соединения сами, чтобы обработчики соединений завершились до остановки цикла событий
+        self._server.close()
+        for writer in self._connections.values():
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        application = self.application
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                (size,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                body = await reader.readexactly(size)
+                await application.update_queue.put(Update.de_json(json.loads(body), application.bot))
+                writer.write(_ACK)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+
+
+async def _run_worker(build_application, index: int) -> None:
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    application = build_application()
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    await application.start()
+    server = _UpdateServer(application, index)
+    await server.start()
+    try:
+        await stopping.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+
+
+def _worker_main(build_application, index: int, count: int) -> None:
+    global shard
+    shard = (index, count)
+    # Общий лимит запросов к domopult делится между обработчиками поровну
+    api.rate_limiter.global_bucket = TokenBucket(UPSTREAM_RATE / count, max(UPSTREAM_BURST / count, 1))
+    asyncio.run(_run_worker(build_application, index))
+
+
+# Приемник
+
+class WorkerLink:
+    """Процесс-обработчик и соединение приемника с ним.
+
+    Подтверждения приходят в порядке отправки кадров, поэтому ожидающие
+    их запросы хранятся в очереди. При обрыве соединения все ожидающие
+    получают ошибку, и приемник отвечает Telegram 503, чтобы тот
+    повторил доставку.
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: multiprocessing.Process | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._pending = collections.deque()
+        self._acks: asyncio.Task | None = None
+
+    def start(self, context, build_application, count: int) -> None:
+        self.process = context.Process(
+            target=_worker_main, args=(build_application, self.index, count), name=f'nvbq-worker-{self.index}',
+        )
+        self.process.start()
+
+    async def connect(self) -> bool:
+        # Сокет появляется, когда обработчик закончит запуск
+        while self.process.is_alive():
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(socket_path(self.index))
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.2)
+                continue
+            self._acks = asyncio.create_task(self._read_acks(reader, self._writer))
+            return True
+        return False
+
+    async def _read_acks(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                await reader.readexactly(len(_ACK))
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(None)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # К этому моменту приемник мог уже подключиться к перезапущенному обработчику
+            if self._writer is writer:
+                self.disconnect()
+
+    def disconnect(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(f"обработчик {self.index} недоступен"))
+
+    async def send(self, body: bytes) -> None:
+        if self._writer is None:
+            raise ConnectionError(f"обработчик {self.index} недоступен")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self._writer.write(_HEADER.pack(len(body)) + body)
+        await self._writer.drain()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), CLUSTER_ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Место в очереди подтверждений остается, запоздавшее подтверждение будет пропущено
+            future.cancel()
+            raise
+
+    async def supervise(self, context, build_application, count: int, stopping: asyncio.Event) -> None:
+        # Упавший обработчик перезапускается; его пользователи ждут, пока он поднимется
+        while not stopping.is_set():
+            self.start(context, build_application, count)
+            await self.connect()
+            while self.process.is_alive() and not stopping.is_set():
+                await asyncio.sleep(1)
+            self.disconnect()
+            if not stopping.is_set():
+                logger.warning(f"Обработчик {self.index} завершился с кодом {self.process.exitcode}, перезапускаем")
+                await asyncio.sleep(1)
+
+    async def stop(self, timeout: float = 30) -> None:
+        if self.process is None:
+            return
+        self.process.terminate()
+        await asyncio.get_running_loop().run_in_executor(None, self.process.join, timeout)
+        if self.process.is_alive():
+            logger.warning(f"Обработчик {self.index} не остановился за {timeout} с, завершаем принудительно")
+            self.process.kill()
+
+
+async def _dispatch(links: list, request_line: bytes, headers: dict, body: bytes) -> str:
+    parts = request_line.decode('latin-1').split()
+    if len(parts) < 2 or parts[0] != 'POST' or parts[1].split('?')[0] != '/' + WEBHOOK_PATH.strip('/'):
+        return '404 Not Found'
+    if WEBHOOK_SECRET and not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), WEBHOOK_SECRET):
+        return '403 Forbidden'
+    try:
+        owner = raw_update_owner(json.loads(body))
+    except ValueError:
+        return '400 Bad Request'
+    # Обновления без пользователя и чата всегда идут первому обработчику
+    index = owner % len(links) if owner is not None else 0
+    try:
+        await links[index].send(body)
+    except (ConnectionError, asyncio.TimeoutError):
+        INGRESS_UPDATES.inc(str(index), 'unavailable')
+        return '503 Service Unavailable'
+    INGRESS_UPDATES.inc(str(index), 'delivered')
+    return '200 OK'
+
+
+async def _handle_webhook(links: list, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    # Telegram держит соединения открытыми, поэтому читаем запросы, пока клиент не закроет соединение
+    try:
+        while True:
+            request_line = await asyncio.wait_for(reader.readline(), 120)
+            if not request_line:
+                break
+            headers = {}
+            while (line := await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await asyncio.wait_for(reader.readexactly(int(headers.get('content-length', 0))), 5)
+            status = await _dispatch(links, request_line, headers, body)
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n\r\n".encode())
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _run_ingress(build_application) -> None:
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    os.makedirs(CLUSTER_SOCKET_DIR, exist_ok=True)
+    links = [WorkerLink(index) for index in range(CLUSTER_WORKERS)]
+    # Порты занимаем до запуска обработчиков, чтобы при ошибке не оставить их без приемника
+    server = await asyncio.start_server(lambda r, w: _handle_webhook(links, r, w), WEBHOOK_LISTEN, WEBHOOK_PORT)
+    metrics_server = await metrics.start_server(METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None
+    # spawn: обработчики не наследуют цикл событий и соединения приемника
+    context = multiprocessing.get_context('spawn')
+    supervisors = [
+        asyncio.create_task(link.supervise(context, build_application, CLUSTER_WORKERS, stopping)) for link in links
+    ]
+    if WEBHOOK_URL:
+        async with Bot(TELEGRAM_TOKEN) as bot:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+    logger.warning(f"Приемник слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}, обработчиков: {CLUSTER_WORKERS}")
+    try:
+        await stopping.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        if metrics_server is not None:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+        await asyncio.gather(*(link.stop() for link in links))
+        await asyncio.gather(*supervisors, return_exceptions=True)
+
+
+def run(build_application) -> None:
+    """Запускает приемник вебхука и CLUSTER_WORKERS процессов-обработчиков.
+
+    Приемник только разбирает JSON обновления и передает его обработчику
+    с номером telegram_id % CLUSTER_WORKERS, поэтому все обновления и
+    состояния разговоров пользователя остаются в одном процессе. Общие
+    данные (токены, user_data, истории) лежат в SQLite в режиме WAL, с
+    которой процессы работают одновременно; кеши в памяти у каждого
+    обработчика свои и содержат только его пользователей.
+    build_application вызывается в каждом обработчике и должно быть
+    функцией верхнего уровня модуля.
+    """
+    asyncio.run(_run_ingress(build_application))
@@ -1 +1,103 @@
-TELEGRAM_TOKEN = 'token'
\ No newline at end of file
+TELEGRAM_TOKEN = 'token'
+
+# Настройки HTTP-клиента для запросов к domopult
+HTTP_TIMEOUT = 15.0           # общий таймаут запроса, секунды
+HTTP_CONNECT_TIMEOUT = 5.0    # таймаут установки соединения, секунды
+HTTP_MAX_CONNECTIONS = 100    # максимум одновременных соединений
+HTTP_MAX_KEEPALIVE = 20       # максимум соединений, удерживаемых в пуле
+
+# Настройки базы данных
+DB_PATH = 'tokens.db'
+DB_BUSY_TIMEOUT = 5.0         # ожидание снятия блокировки, секунды
+TOKEN_CACHE_SIZE = 10000      # максимум пользователей в кеше токенов
+TOKEN_CACHE_TTL = 600         # время жизни записи кеша токенов, секунды
+PERSISTENCE_INTERVAL = 10     # как часто сохранять изменившиеся user_data и состояния разговоров, секунды
+SESSION_IDLE_TTL = 1800       # через сколько секунд выгружать из памяти данные личного кабинета пользователя
+SESSION_EVICT_INTERVAL = 300  # как часто искать такие данные, секунды; 0 - не выгружать
+
+# Кеш ответов domopult (на пользователя)
+RESPONSE_CACHE_SIZE = 5000    # максимум пользователей в кеше ответов
+RESPONSE_CACHE_TTL = {        # время жизни по группам эндпоинтов, секунды
+    'configuration_items': 3600,
+    'payments': 300,
+    'meters': 300,
+}
+DASHBOARD_DEADLINE = 8.0      # общий дедлайн на сборку личного кабинета, секунды
+RENDER_CACHE_SIZE = 10000     # максимум готовых к отправке отрисовок подробной информации
+RENDER_CACHE_TTL = 3600       # время жизни отрисовки, секунды
+
+# Кеш квитанций
+RECEIPTS_DIR = 'receipts'     # каталог с копиями PDF, разложенными по хешу содержимого
+RECEIPT_CHUNK_SIZE = 64 * 1024           # размер части при потоковом скачивании, байты
+RECEIPT_SPOOL_SIZE = 1024 * 1024         # сколько байт одной квитанции держать в памяти до сброса на диск
+RECEIPT_MEMORY_BUDGET = 32 * 1024 * 1024 # общий бюджет памяти на одновременные скачивания, байты
+RECEIPT_EXPORT_CONCURRENCY = 4           # одновременных скачиваний при выгрузке квитанций за год
+
+# История показаний счётчиков
+READING_HISTORY_MONTHS = 6    # сколько последних месяцев показывать в расходе
+READING_ANOMALY_FACTOR = 2.0  # расход выше среднего во столько раз считается аномальным
+
+# Очередь передачи показаний счётчиков
+OUTBOX_INTERVAL = 5           # как часто проверять очередь, секунды
+OUTBOX_BATCH = 100            # сколько показаний отправлять за один проход
+OUTBOX_CONCURRENCY = 8        # одновременных отправок показаний
+OUTBOX_MAX_ATTEMPTS = 10      # попыток отправки, после которых пользователю сообщается об ошибке
+OUTBOX_RETRY_BACKOFF = 15     # базовая задержка между попытками, удваивается с каждой попыткой, секунды
+OUTBOX_RETRY_MAX_DELAY = 1800 # максимальная задержка между попытками, секунды
+
+# Рассылки
+ADMIN_IDS = ()                # telegram_id администраторов, которым доступны команды /broadcast*
+BROADCAST_RATE = 25           # общий лимит рассылок, сообщений в секунду (Telegram допускает около 30)
+BROADCAST_CHAT_RATE = 1       # лимит на один чат, сообщений в секунду
+BROADCAST_BATCH = 200         # получателей, читаемых из базы за раз
+BROADCAST_CONCURRENCY = 10    # одновременных отправок
+BROADCAST_POLL_INTERVAL = 60  # как часто проверять незавершенные рассылки, секунды
+READING_REMINDER_DAY = 20     # день месяца для напоминания о передаче показаний; 0 - не напоминать
+READING_REMINDER_TIME = (12, 0)  # время напоминания по местному времени, часы и минуты
+
+# Уведомления об изменениях в личном кабинете
+WATCH_INTERVAL = 3600         # как часто проверять кабинет каждого подписанного пользователя, секунды
+WATCH_TICK = 60               # как часто искать пользователей, которых пора проверить, секунды; 0 - отключить
+WATCH_BATCH = 200             # максимум проверок за один проход
+WATCH_CONCURRENCY = 4         # одновременных проверок
+
+# История платежей
+PAYMENT_SYNC_PAGE_SIZE = 50   # платежей на страницу при синхронизации с domopult
+PAYMENT_SYNC_INTERVAL = 300   # не синхронизировать историю одного счета чаще, секунды
+PAYMENT_HISTORY_PAGE_SIZE = 10  # платежей на странице истории в боте
+
+# Режим работы бота
+BOT_MODE = 'polling'          # 'polling' или 'webhook'
+CONCURRENT_UPDATES = 64       # сколько обновлений разных пользователей обрабатывать одновременно
+WEBHOOK_LISTEN = '127.0.0.1'  # адрес локального HTTP-сервера для вебхука
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = 'telegram'     # путь, на который обратный прокси передает обновления
+WEBHOOK_URL = ''              # публичный адрес вебхука, например https://example.com/telegram
+WEBHOOK_SECRET = ''           # секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+
+# Несколько процессов-обработчиков за одним приемником вебхука
+CLUSTER_WORKERS = 0           # число процессов-обработчиков; 0 - весь бот в одном процессе
+CLUSTER_SOCKET_DIR = 'run'    # каталог с сокетами, через которые приемник передает обновления обработчикам
+CLUSTER_ACK_TIMEOUT = 10.0    # сколько ждать, пока обработчик примет обновление, секунды
+
+# Политика исходящих запросов к domopult
+UPSTREAM_RATE = 50            # общий лимит, запросов в секунду
+UPSTREAM_BURST = 100          # допустимый всплеск сверх общего лимита
+USER_RATE = 2                 # лимит на одного пользователя, запросов в секунду
+USER_BURST = 10               # допустимый всплеск для одного пользователя
+RETRY_ATTEMPTS = 3            # попыток для GET-запросов при сетевых ошибках и ответах 5xx
+RETRY_BACKOFF = 0.5           # базовая задержка между попытками, секунды
+CIRCUIT_FAILURE_THRESHOLD = 10  # ошибок подряд, после которых запросы перестают отправляться
+CIRCUIT_RESET_TIMEOUT = 30    # через сколько секунд пробовать снова, секунды
+
+# Метрики в формате Prometheus
+METRICS_LISTEN = '127.0.0.1'  # адрес HTTP-сервера с метриками
+METRICS_PORT = 9108           # порт, метрики доступны по пути /metrics; 0 - отключить
+
+# Фоновый прогрев кеша и проверка токенов
+PREWARM_INTERVAL = 1800       # как часто запускать прогрев, секунды; 0 - отключить
+PREWARM_HOURS = (5, 8)        # окно низкой нагрузки по местному времени: с 5:00 до 8:00
+PREWARM_ACTIVE_DAYS = 7       # прогревать пользователей, обращавшихся к боту за последние дни
+PREWARM_CONCURRENCY = 4       # одновременно прогреваемых пользователей
+PREWARM_JITTER = 2.0          # случайная пауза перед прогревом каждого пользователя, секунды
+PREWARM_TTL = 4 * 3600        # время жизни прогретых записей кеша, секунды
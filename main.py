@@ -1,24 +1,45 @@
-import requests
+import asyncio
+import html
 import logging
-import sqlite3
+import random
 import re
+import tempfile
+from datetime import datetime, time as dt_time
 from warnings import filterwarnings
-from config import TELEGRAM_TOKEN
+import api
+import cluster
+import metrics
+import prewarm
+from session import AccountSession, evict_idle_sessions
+from render import cached_pages, paginate_pre, format_number
+from persistence import SqlitePersistence
+from metrics import timed_handler
+from storage import token_store
+from updates import PerUserUpdateProcessor
+from receipts import receipt_store, is_closed_period, download_receipt, export_year
+from readings import reading_store, meter_summary, parse_batch, TARIFF_NAMES
+from payments import payment_store, sync_payments
+from outbox import outbox_store, outbox_job, schedule_delivery
+from broadcast import broadcast_store, broadcast_job, reading_reminder_job, start_broadcast, format_summary
+from watch import watch_store, watch_job
+from config import (
+    TELEGRAM_TOKEN, DASHBOARD_DEADLINE, BOT_MODE, CONCURRENT_UPDATES,
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET, CLUSTER_WORKERS,
+    METRICS_LISTEN, METRICS_PORT, PREWARM_INTERVAL, SESSION_IDLE_TTL, SESSION_EVICT_INTERVAL,
+    PAYMENT_HISTORY_PAGE_SIZE, OUTBOX_INTERVAL,
+    ADMIN_IDS, BROADCAST_POLL_INTERVAL, READING_REMINDER_DAY, READING_REMINDER_TIME, WATCH_TICK,
+)
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.ext import Application, CommandHandler, MessageHandler, ConversationHandler, CallbackQueryHandler, TypeHandler, ContextTypes, filters
+from telegram.error import TelegramError
+from telegram.request import BaseRequest
 from telegram.warnings import PTBUserWarning
 from dateutil import parser as dateutil_parser
 
 # Задаем состояния разговора
 CHOOSING_METHOD, PHONE, EMAIL, PASSWORD, SMS_CODE = range(5)
 SELECT_YEAR, SELECT_MONTH, SEND_RECEIPT = range(3)
-SELECT_METER, INPUT_READING, INPUT_READINGS = range(3)
-
-# URL для получения кода и авторизации
-SMS_CODE_URL = "https://nvs.domopult.ru/api/tenants-registration/code"
-LOGIN_URL = "https://nvs.domopult.ru/api/tenants-registration/login"
-PERSONAL_ACCOUNT_URL = "https://nvs.domopult.ru/api/api/personal_account/payments/{personal_account_id}?query=&sort=&page=0&size=15"
-CLIENTS_CONFIGURATION_ITEMS_URL = "https://nvs.domopult.ru/api/api/clients/configuration-items"
+SELECT_METER, INPUT_READING, INPUT_READINGS, INPUT_ALL_READINGS = range(4)
 
 ascii_art = """
         ██████╗ ██╗   ██╗     ██████╗ ██╗   ██╗ ██╗███████╗███████╗██╗     ██╗   ██╗███████╗███████╗    
@@ -29,8 +50,6 @@ ascii_art = """
         ╚═════╝    ╚═╝        ╚══▀▀═╝  ╚═════╝  ╚═╝╚══════╝╚══════╝╚══════╝   ╚═╝   ╚══════╝╚══════╝ 
         NVBQ - Неофициальный бот района "Новые Ватутинки". Версия: 1.0.0 (20 июля 2024г.)
     """
-print(ascii_art)
-
 # Включаем логирование
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING
@@ -39,139 +58,64 @@ logger = logging.getLogger(__name__)
 
 filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
 
-def init_db():
-    conn = sqlite3.connect('tokens.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_tokens (
-            telegram_id INTEGER PRIMARY KEY,
-            auth_token TEXT NOT NULL,
-            personal_account_id TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-
-def save_token(telegram_id, auth_token):
-    conn = sqlite3.connect('tokens.db')
-    c = conn.cursor()
-    c.execute('''
-        INSERT OR REPLACE INTO user_tokens (telegram_id, auth_token)
-        VALUES (?, ?)
-    ''', (telegram_id, auth_token))
-    conn.commit()
-    conn.close()
-
-def get_token(telegram_id):
-    conn = sqlite3.connect('tokens.db')
-    c = conn.cursor()
-    c.execute('SELECT auth_token FROM user_tokens WHERE telegram_id = ?', (telegram_id,))
-    token = c.fetchone()
-    conn.close()
-    return token[0] if token else None
-
-def get_personal_account_id(user_id):
-    conn = sqlite3.connect('tokens.db')
-    c = conn.cursor()
-    c.execute('SELECT personal_account_id FROM user_tokens WHERE telegram_id = ?', (user_id,))
-    personal_account_id = c.fetchone()
-    conn.close()
-    return personal_account_id[0] if personal_account_id else None
-
-def delete_token(telegram_id):
-    conn = sqlite3.connect('tokens.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM user_tokens WHERE telegram_id = ?', (telegram_id,))
-    conn.commit()
-    conn.close()
-
-def save_personal_account_id(user_id, personal_account_id):
-    conn = sqlite3.connect('tokens.db')
-    c = conn.cursor()
-    c.execute('UPDATE user_tokens SET personal_account_id = ? WHERE telegram_id = ?', (personal_account_id, user_id))
-    conn.commit()
-    conn.close()
-
-def parse_and_format_data(data):
-    results = data.get('results', [])
-    if not results:
+def parse_and_format_data(session: AccountSession):
+    if not session.payments:
         return "Нет данных для отображения."
 
     messages = []
-    for result in results:
-        personal_account = result.get('personalAccount', {})
-        client = result.get('client', {})
-        contact = client.get('contact', {})
-        basic_config_item = contact.get('basicConfigurationItem', {})
-        creation_method = result.get('creationMethod', 'Не указан')
-        login_methods = [method.get('key') for method in result.get('loginMethods', [])]
-        login_methods_message = ', '.join(login_methods) if login_methods else 'Не указаны'
-
-
-        # Дата создания
-        creation_date = result.get('creationDate')
-        if creation_date:
-            creation_date = dateutil_parser.isoparse(creation_date).strftime('%d.%m.%Y %H:%M:%S')
-
-        # Долговая информация
-        debtor_info = result.get('debtorInfo', {})
-        is_debtor = debtor_info.get('isDebtor', False)
-        service_overall_debt = debtor_info.get('serviceOverallDebt')
-        debt_message = "Нет долгов" if not is_debtor else f"Общий долг: {service_overall_debt or 'Не указан'}"
-
-        # Группы CI
-        ci_groups = personal_account.get('configurationItem', {}).get('ciGroups', [])
-        ci_groups_message = '\n'.join([
-            f"  ID: {group.get('id')} - Название: {group.get('name')} ({group.get('description')})"
-            for group in ci_groups
-        ]) or 'Нет групп CI'
-
+    for payment in session.payments:
         message = (
-            f"  {creation_date}:\n"
-            f"      ID: {result.get('id')}\n"
-            f"      ID транзакции: {result.get('transactionalId')}\n"
-            f"      Статус: {result.get('status')}\n"   
-            f"      Тип платежа: {result.get('paymentType')}\n"
-            f"      Тип сервиса: {result.get('serviceType')}\n"
-            f"      Баланс: {result.get('balance')} ₽\n"
-            f"      Сумма платежа: {result.get('paymentSum')} ₽\n"
-            f"      Страхование: {result.get('paymentInsurance')}₽\n"
-            f"      Сумма без страхования: {result.get('paymentSumWithoutInsurance')} ₽\n\n"
+            f"  {payment.creation_date}:\n"
+            f"      ID: {payment.id}\n"
+            f"      ID транзакции: {payment.transactional_id}\n"
+            f"      Статус: {payment.status}\n"
+            f"      Тип платежа: {payment.payment_type}\n"
+            f"      Тип сервиса: {payment.service_type}\n"
+            f"      Баланс: {payment.balance} ₽\n"
+            f"      Сумма платежа: {payment.payment_sum} ₽\n"
+            f"      Страхование: {payment.payment_insurance}₽\n"
+            f"      Сумма без страхования: {payment.payment_sum_without_insurance} ₽\n\n"
         )
         messages.append(message)
 
+    login_methods_message = ', '.join(session.login_methods) if session.login_methods else 'Не указаны'
+    debt_message = "Нет долгов" if not session.is_debtor else f"Общий долг: {session.service_overall_debt or 'Не указан'}"
+    ci_groups_message = '\n'.join([
+        f"  ID: {group_id} - Название: {name} ({description})"
+        for group_id, name, description in session.ci_groups
+    ]) or 'Нет групп CI'
+
     personal_account_info = (
         f"Личный счет:\n"
-        f"  ID: {personal_account.get('id')}\n"
-        f"  Номер: {personal_account.get('number')}\n"
-        f"  Баланс по коммунальным услугам: {personal_account.get('utilitiesBalance')} ₽\n"
-        f"  Баланс по ремонту: {personal_account.get('repairsBalance')} ₽\n"
-        f"  Активен: {'Да' if personal_account.get('isActive') else 'Нет'}\n\n"
+        f"  ID: {session.account_id}\n"
+        f"  Номер: {session.account_number_detail}\n"
+        f"  Баланс по коммунальным услугам: {session.account_utilities_balance} ₽\n"
+        f"  Баланс по ремонту: {session.account_repairs_balance} ₽\n"
+        f"  Активен: {'Да' if session.account_is_active else 'Нет'}\n\n"
     )
 
     client_info = (
         f"Клиент:\n"
-        f"  ID: {client.get('id')}\n"
-        f"  Имя: {contact.get('name')}\n"
-        f"  Телефон: {contact.get('phone')}\n"
-        f"  Email: {contact.get('emails', [{}])[0].get('email', 'Не указан')}\n"
-        f"  Рекламные рассылки: {contact.get('advertisingMailing')}\n\n"
+        f"  ID: {session.client_id}\n"
+        f"  Имя: {session.client_name}\n"
+        f"  Телефон: {session.client_phone}\n"
+        f"  Email: {session.client_email}\n"
+        f"  Рекламные рассылки: {session.client_advertising_mailing}\n\n"
     )
 
     basic_config_item_info = (
         f"Информация о месте проживания:\n"
-        f"  ID: {basic_config_item.get('id')}\n"
-        f"  Название: {basic_config_item.get('name')}\n"
-        f"  Адрес: {basic_config_item.get('address', {}).get('location')}\n"
-        f"  Категория: {basic_config_item.get('category', {}).get('name')}\n"
-        f"  Тип помещения: {basic_config_item.get('roomType')}\n"
-        f"  Парковка: {'Да' if basic_config_item.get('hasParking') else 'Нет'}\n"
-        f"  Игровая площадка: {'Да' if basic_config_item.get('hasPlayground') else 'Нет'}\n"
-        f"  Спортивная площадка: {'Да' if basic_config_item.get('hasSportsGround') else 'Нет'}\n"
-        f"  Включены счетчики: {'Горячая вода' if basic_config_item.get('meterFlags', {}).get('hotWaterAllowed') else ''} "
-        f"{'Холодная вода' if basic_config_item.get('meterFlags', {}).get('coldWaterAllowed') else ''}\n"
-        f"  Метод создания: {creation_method}\n"
+        f"  ID: {session.place_id}\n"
+        f"  Название: {session.place_name}\n"
+        f"  Адрес: {session.place_location}\n"
+        f"  Категория: {session.place_category}\n"
+        f"  Тип помещения: {session.place_room_type}\n"
+        f"  Парковка: {'Да' if session.place_has_parking else 'Нет'}\n"
+        f"  Игровая площадка: {'Да' if session.place_has_playground else 'Нет'}\n"
+        f"  Спортивная площадка: {'Да' if session.place_has_sports_ground else 'Нет'}\n"
+        f"  Включены счетчики: {'Горячая вода' if session.place_hot_water else ''} "
+        f"{'Холодная вода' if session.place_cold_water else ''}\n"
+        f"  Метод создания: {session.creation_method}\n"
         f"  Методы входа: {login_methods_message}\n"
         f"  Долговая информация: {debt_message}\n\n"
     )
@@ -191,12 +135,13 @@ def parse_and_format_data(data):
 
     return combined_message
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     first_name = user.first_name
     user_id = user.id
 
-    auth_token = get_token(user_id)
+    auth_token = await token_store.get_token(user_id)
     if auth_token:
         await account_info(update, context)
         return ConversationHandler.END
@@ -215,6 +160,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['start_message_id'] = sent_message.message_id
     return CHOOSING_METHOD
 
+@timed_handler
 async def choose_method(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -230,6 +176,7 @@ async def choose_method(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await query.edit_message_text(text="*❌ Неизвестный метод авторизации.*\n└ Пожалуйста, выберите метод входа снова.", parse_mode='MARKDOWN')
         return CHOOSING_METHOD
 
+@timed_handler
 async def phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     phone = update.message.text
     if not phone.startswith('+7') or len(phone) != 12:
@@ -240,7 +187,14 @@ async def phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return PHONE
 
     chat_id = update.message.chat_id
-    response = requests.post(SMS_CODE_URL, json={"phone": phone})
+    try:
+        response = await api.request_sms_code(phone)
+    except api.ApiError as e:
+        logger.warning(f"Ошибка при отправке СМС-кода: {e}")
+        await update.message.reply_text(
+            "*❌ Ошибка при отправке СМС-кода.*\n└ Пожалуйста, попробуйте снова.", parse_mode='MARKDOWN'
+        )
+        return PHONE
     if response.status_code == 200:
         await update.message.delete()
 
@@ -268,6 +222,7 @@ async def phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return PHONE
 
+@timed_handler
 async def email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     email = update.message.text
     
@@ -295,6 +250,7 @@ async def email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.delete()
     return PASSWORD
 
+@timed_handler
 async def password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     password = update.message.text
     context.user_data['password'] = password
@@ -306,16 +262,23 @@ async def password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return CHOOSING_METHOD
 
-    response = requests.post(LOGIN_URL, json={
-        "email": email,
-        "password": password,
-        "loginMethod": "PERSONAL_OFFICE"
-    })
+    try:
+        response = await api.login({
+            "email": email,
+            "password": password,
+            "loginMethod": "PERSONAL_OFFICE"
+        })
+    except api.ApiError as e:
+        logger.warning(f"Ошибка авторизации по почте: {e}")
+        await update.message.reply_text(
+            "<b>❌ Произошла ошибка при обработке запроса.</b>\n└ Пожалуйста, попробуйте снова.", parse_mode='HTML'
+        )
+        return PASSWORD
 
     if response.status_code == 200:
         auth_token = response.text.strip()
         if auth_token:
-            save_token(update.effective_user.id, auth_token)
+            await token_store.save_token(update.effective_user.id, auth_token)
 
             await update.message.delete()
 
@@ -337,6 +300,7 @@ async def password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return 
 
+@timed_handler
 async def sms_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     sms_code = update.message.text
     user_id = update.effective_user.id
@@ -347,12 +311,18 @@ async def sms_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return ConversationHandler.END
 
-    response = requests.post(LOGIN_URL, json={"phone": phone, "code": sms_code})
+    try:
+        response = await api.login({"phone": phone, "code": sms_code})
+    except api.ApiError as e:
+        logger.warning(f"Ошибка авторизации по номеру телефона: {e}")
+        await update.message.reply_text(
+            "<b>❌ Произошла ошибка при обработке запроса.</b>\n└ Пожалуйста, попробуйте снова.", parse_mode='HTML'
+        )
+        return SMS_CODE
     if response.status_code == 200:
         auth_token = response.text.strip()
-        print(auth_token)
         if auth_token:
-            save_token(user_id, auth_token)
+            await token_store.save_token(user_id, auth_token)
             await update.message.delete()
 
             phone_msg_id = context.user_data.get('phone_msg_id')
@@ -373,93 +343,112 @@ async def sms_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return PHONE
 
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     await query.edit_message_text(text="*✅ Процесс авторизации отменен.*", parse_mode='MARKDOWN')
     return ConversationHandler.END
 
-async def account_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@timed_handler
+async def account_info(update: Update, context: ContextTypes.DEFAULT_TYPE, force_refresh: bool = False) -> None:
     user_id = update.effective_user.id
     first_name = update.effective_user.first_name
-    auth_token = get_token(user_id)
+    auth_token = await token_store.get_token(user_id)
 
     if not auth_token:
         await send_account_info(update, context, "*❌ Ваша авторизация не завершена.*\n└ Пожалуйста, пройдите процесс авторизации.", parse_mode='MARKDOWN')
         return
 
-    headers = {
-        'X-Auth-Tenant-Token': f'{auth_token}',
-        'Content-Type': 'application/json'
-    }
-
+    # Общий дедлайн на сборку всего личного кабинета
+    deadline = asyncio.get_running_loop().time() + DASHBOARD_DEADLINE
     try:
-        response = requests.get(CLIENTS_CONFIGURATION_ITEMS_URL, headers=headers)
+        response = await asyncio.wait_for(api.get_configuration_items(auth_token, force_refresh), DASHBOARD_DEADLINE)
 
         if response.status_code == 200:
             data = response.json()
             items = data.get('items', [])
             if items:
                 personal_account_id = items[0].get('personalAccount', {}).get('id')
+                configuration_item_id = items[0].get('id')
                 if personal_account_id:
-                    save_personal_account_id(user_id, personal_account_id)
-
-                    url = PERSONAL_ACCOUNT_URL.format(personal_account_id=personal_account_id)
-                    response = requests.get(url, headers=headers)
-
-                    if response.status_code == 200:
-                        data = response.json()
-                        context.user_data['account_data'] = data
-
-                        personal_account = data.get('results', [{}])[0].get('personalAccount', {})
-                        balance = personal_account.get('utilitiesBalance','Неизвестно')
-                        account_number = personal_account.get('number', 'Неизвестно')
-                        address = personal_account.get('configurationItem', {}).get('address', {})
-                        house_info = f"{address.get('location', '')}"
-
-                        configuration_item_id = personal_account.get('configurationItem', {}).get('id')
-                        meters_url = f"https://nvs.domopult.ru/api/api/clients/meters/for-item/{configuration_item_id}"
-                        meters_response = requests.get(meters_url, headers=headers)
-
-                        if meters_response.status_code == 200:
-                            meters_data = meters_response.json()
-                            meters_info = ""
-                            for meter in meters_data:
-                                meter_type = meter.get('meter', {}).get('type', 'Неизвестный тип')
-                                meter_number = meter.get('meter', {}).get('number', 'Неизвестный номер')
-                                last_value = meter.get('meter', {}).get('lastValue', {}).get('total', {}).get('displayValue', 'Нет данных')
-                                meters_info += f"<b>{meter_type}:</b> {meter_number} - Последнее показание: {last_value}\n"
-                        else:
-                            meters_info = "Не удалось получить данные о счётчиках."
-
-                        welcome_message = f"<b>👋 Добро пожаловать в личный кабинет, {first_name}!</b>\n\n"
-                        account_info_message = f"<b>🧾 Лицевой счёт:</b> <code>{account_number}\n</code><b>💸 Баланс счёта:</b> {balance} ₽\n<b>🏠 Помещение:</b> {house_info}\n\n"
-                        meters_message = f"<b>📊 Показания счётчиков:</b>\n{meters_info}\n"
-
-                        keyboard = [
-                            [InlineKeyboardButton("💸 Пополнить баланс", callback_data='top_up_balance')],
-                            [InlineKeyboardButton("📋 Квитанции", callback_data='download_receipt')],
-                            [InlineKeyboardButton("🧭 Счётчики", callback_data='counters')],
-                            [InlineKeyboardButton("⚙️ Подробная информация", callback_data='detailed_info')]
-                        ]
-                        reply_markup = InlineKeyboardMarkup(keyboard)
-
-                        await send_account_info(update, context, welcome_message + account_info_message + meters_message, parse_mode='HTML', reply_markup=reply_markup)
+                    await token_store.save_personal_account_id(user_id, personal_account_id)
+
+                    # Платежи и счётчики зависят только от первого ответа, запрашиваем их параллельно
+                    response, meters_response = await api.gather_until(
+                        deadline,
+                        api.get_payments(auth_token, personal_account_id, force_refresh),
+                        api.get_meters_for_item(auth_token, configuration_item_id, force_refresh),
+                    )
+
+                    if response is not None and response.status_code == 200:
+                        session = response.json()
+                        # Тот же объект, что в кеше ответов: копия полного ответа не хранится
+                        context.user_data['account'] = session
+                        context.user_data.pop('account_data', None)
+
+                        account_info_message = f"<b>🧾 Лицевой счёт:</b> <code>{session.account_number}\n</code><b>💸 Баланс счёта:</b> {session.utilities_balance} ₽\n<b>🏠 Помещение:</b> {session.location}\n\n"
                     else:
-                        await send_account_info(update, context, f"<b>❌ Ошибка при получении информации о счете.</b>\n├ Статус: {response.status_code}\n└ Сообщение: {response.text}", parse_mode='HTML')
+                        status = response.status_code if response is not None else 'нет ответа'
+                        account_info_message = f"<b>❌ Не удалось получить информацию о счёте.</b>\n└ Статус: {status}\n\n"
+
+                    if meters_response is not None and meters_response.status_code == 200:
+                        meters_data = meters_response.json()
+                        await reading_store.record_fetched(user_id, meters_data)
+                        meters_info = ""
+                        for meter in meters_data:
+                            meter_type = meter.get('meter', {}).get('type', 'Неизвестный тип')
+                            meter_number = meter.get('meter', {}).get('number', 'Неизвестный номер')
+                            last_value = meter.get('meter', {}).get('lastValue', {}).get('total', {}).get('displayValue', 'Нет данных')
+                            meters_info += f"<b>{meter_type}:</b> {meter_number} - Последнее показание: {last_value}\n"
+                    else:
+                        meters_info = "Не удалось получить данные о счётчиках."
+
+                    welcome_message = f"<b>👋 Добро пожаловать в личный кабинет, {first_name}!</b>\n\n"
+                    meters_message = f"<b>📊 Показания счётчиков:</b>\n{meters_info}\n"
+
+                    keyboard = [
+                        [InlineKeyboardButton("💸 Пополнить баланс", callback_data='top_up_balance')],
+                        [InlineKeyboardButton("📋 Квитанции", callback_data='download_receipt')],
+                        [InlineKeyboardButton("🧭 Счётчики", callback_data='counters')],
+                        [InlineKeyboardButton("⚙️ Подробная информация", callback_data='detailed_info')],
+                        [InlineKeyboardButton("📜 История платежей", callback_data='history_0')],
+                        [InlineKeyboardButton("🔕 Отключить уведомления" if await watch_store.is_subscribed(user_id) else "🔔 Уведомлять об изменениях", callback_data='watch_toggle')],
+                        [InlineKeyboardButton("🔄 Обновить", callback_data='refresh')]
+                    ]
+                    reply_markup = InlineKeyboardMarkup(keyboard)
+
+                    await send_account_info(update, context, welcome_message + account_info_message + meters_message, parse_mode='HTML', reply_markup=reply_markup)
                 else:
                     await send_account_info(update, context, "*❌ Не удалось найти идентификатор личного счета.*", parse_mode='MARKDOWN')
             else:
                 await send_account_info(update, context, "*❌ Нет данных о клиенте.*", parse_mode='MARKDOWN')
         elif response.status_code == 401:
             await send_account_info(update, context, "*❌ Токен истёк.*\n└ Пожалуйста, пройдите процесс авторизации заново.", parse_mode='MARKDOWN')
-            delete_token(user_id)
+            await token_store.delete_token(user_id)
+            api.response_cache.invalidate(auth_token)
         else:
             await send_account_info(update, context, f"<b>❌ Ошибка при получении информации о клиенте.</b>\n├ Статус: {response.status_code}\n└ Сообщение: {response.text}", parse_mode='HTML')
-    except requests.exceptions.RequestException as e:
-        logger.warning(f"Ошибка при получении информации о счёте: {e}")
+    except (api.ApiError, asyncio.TimeoutError) as e:
+        logger.warning(f"Ошибка при получении информации о счёте: {e!r}")
         await send_account_info(update, context, "<b>❌ Произошла ошибка при обработке запроса.</b>\n└ Пожалуйста, попробуйте снова.", parse_mode='HTML')
 
+@timed_handler
+async def refresh_account_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Принудительно перечитываем данные, минуя кеш ответов
+    await account_info(update, context, force_refresh=True)
+
+@timed_handler
+async def toggle_watch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Вместо ручных обновлений кабинета фоновая проверка сама сообщит об изменениях
+    user_id = update.effective_user.id
+    if await watch_store.is_subscribed(user_id):
+        await watch_store.unsubscribe(user_id)
+    else:
+        await watch_store.subscribe(user_id)
+    # Новое состояние видно по кнопке на перерисованной главной странице
+    await account_info(update, context)
+
 async def send_account_info(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, parse_mode: str = None, reply_markup=None) -> None:
     if update.message:
         message = await update.message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
@@ -468,6 +457,7 @@ async def send_account_info(update: Update, context: ContextTypes.DEFAULT_TYPE,
         message = await update.callback_query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
     context.user_data['last_bot_message_id'] = message.message_id
 
+@timed_handler
 async def top_up_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -480,21 +470,39 @@ async def top_up_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Здесь можно добавить логику для пополнения баланса
     await query.edit_message_text(text="*⚙️ Разработка*\n└ Сейчас эта функция недоступна, попробуйте зайти сюда позже.", parse_mode='MARKDOWN', reply_markup=reply_markup)
 
+@timed_handler
 async def detailed_info_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
 
-    data = context.user_data.get('account_data')
-    if data:
-        formatted_data = parse_and_format_data(data)
-        
-        keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data='start')]
-        ]
+    session = context.user_data.get('account')
+    if session is None:
+        # Сессия могла быть вытеснена по простою, загружаем заново (обычно из кеша ответов)
+        session = await load_account_session(update.effective_user.id)
+        if session is not None:
+            context.user_data['account'] = session
+    if session is not None:
+        # Страницы берутся из кеша по хешу ответа, длинный текст делится по лимиту Telegram
+        pages = cached_pages(
+            'detailed_info', session.digest,
+            lambda: paginate_pre(parse_and_format_data(session)),
+        )
+        page = int(query.data.rsplit('_', 1)[1]) if query.data != 'detailed_info' else 0
+        page = min(page, len(pages) - 1)
+
+        keyboard = []
+        if len(pages) > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton(f"◀️ {page}/{len(pages)}", callback_data=f'detailed_info_{page - 1}'))
+            if page + 1 < len(pages):
+                navigation.append(InlineKeyboardButton(f"{page + 2}/{len(pages)} ▶️", callback_data=f'detailed_info_{page + 1}'))
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='start')])
         reply_markup = InlineKeyboardMarkup(keyboard)
-        
+
         await query.edit_message_text(
-            text=f"<pre>{formatted_data}</pre>", 
+            text=pages[page],
             parse_mode='HTML',
             reply_markup=reply_markup
         )
@@ -504,6 +512,7 @@ async def detailed_info_handler(update: Update, context: ContextTypes.DEFAULT_TY
             parse_mode='HTML'
         )
 
+@timed_handler
 async def ask_for_year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -515,6 +524,7 @@ async def ask_for_year(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     context.user_data['last_bot_message_id'] = message.message_id
     return SELECT_YEAR
 
+@timed_handler
 async def handle_year_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     selected_year = update.message.text
     if not selected_year.isdigit() or len(selected_year) != 4:
@@ -526,11 +536,15 @@ async def handle_year_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
     return await ask_for_month(update, context)
 
+@timed_handler
 async def ask_for_month(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    message = await update.message.reply_text("*✨ Квитанции\n*└ Пожалуйста, введите месяц для получения квитанции (например, 01 для января):", parse_mode='MARKDOWN')
+    keyboard = [[InlineKeyboardButton("📦 Все квитанции за год одним архивом", callback_data='receipt_year')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    message = await update.message.reply_text("*✨ Квитанции\n*└ Пожалуйста, введите месяц для получения квитанции (например, 01 для января):", parse_mode='MARKDOWN', reply_markup=reply_markup)
     context.user_data['last_bot_message_id'] = message.message_id
     return SELECT_MONTH
 
+@timed_handler
 async def handle_month_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     selected_month = update.message.text
     if not selected_month.isdigit() or len(selected_month) != 2 or not 1 <= int(selected_month) <= 12:
@@ -542,78 +556,136 @@ async def handle_month_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
     return await send_receipt(update, context)
 
+async def send_cached_receipt(context: ContextTypes.DEFAULT_TYPE, chat_id: int, personal_account_id, year, month, filename: str) -> bool:
+    cached = await receipt_store.get(personal_account_id, year, month)
+    if cached is None:
+        return False
+    file_id, path = cached
+
+    # Повторная отправка по file_id не требует ни скачивания, ни загрузки файла
+    if file_id:
+        try:
+            await context.bot.send_document(chat_id=chat_id, document=file_id)
+            return True
+        except TelegramError as e:
+            logger.warning(f"Не удалось отправить квитанцию по file_id: {e}")
+
+    if path:
+        receipt_file = await asyncio.to_thread(open, path, 'rb')
+        with receipt_file:
+            message = await context.bot.send_document(chat_id=chat_id, document=receipt_file, filename=filename)
+        await receipt_store.set_file_id(personal_account_id, year, month, message.document.file_id)
+        return True
+    return False
+
+@timed_handler
 async def send_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    auth_token = get_token(user_id)
-    personal_account_id = get_personal_account_id(user_id)
+    auth_token, personal_account_id = await token_store.get_credentials(user_id)
     selected_year = context.user_data.get('selected_year')
     selected_month = context.user_data.get('selected_month')
-
-    headers = {
-        'X-Auth-Tenant-Token': f'{auth_token}',
-        'Content-Type': 'application/json'
-    }
-
-    url = f"https://nvs.domopult.ru/api/api/personal_account/receipts_by_period/{personal_account_id}?date={selected_year}-{selected_month}-01&serviceType=UTILITIES"
+    filename = f"{selected_year}-{selected_month}-01.pdf"
+    cacheable = is_closed_period(selected_year, selected_month)
 
     try:
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            receipt_file = response.content
-            await context.bot.send_document(chat_id=update.effective_chat.id, document=receipt_file, filename=f"{selected_year}-{selected_month}-01.pdf")
-        elif response.status_code == 400:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='start')],]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text("*❌ Квитанции\n*└ Квитанция для выбранного периода недоступна, попробуйте позже.", parse_mode='MARKDOWN',reply_markup=reply_markup)
+        if cacheable and await send_cached_receipt(context, update.effective_chat.id, personal_account_id, selected_year, selected_month, filename):
+            await account_info(update, context)
             return ConversationHandler.END
-        else:
-            await update.message.reply_text(f"<b>❌ Ошибка при получении квитанций.</b>\n├ Статус: {response.status_code}\n└ Сообщение: {response.text}", parse_mode='HTML')
-    except requests.exceptions.RequestException as e:
+
+        async with download_receipt(auth_token, personal_account_id, selected_year, selected_month) as (response, receipt_file):
+            if response.status_code == 200:
+                message = await context.bot.send_document(chat_id=update.effective_chat.id, document=receipt_file, filename=filename)
+                if cacheable:
+                    await receipt_store.save(personal_account_id, selected_year, selected_month, receipt_file, message.document.file_id)
+            elif response.status_code == 400:
+                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='start')],]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                await update.message.reply_text("*❌ Квитанции\n*└ Квитанция для выбранного периода недоступна, попробуйте позже.", parse_mode='MARKDOWN',reply_markup=reply_markup)
+                return ConversationHandler.END
+            else:
+                await update.message.reply_text(f"<b>❌ Ошибка при получении квитанций.</b>\n├ Статус: {response.status_code}\n└ Сообщение: {response.text}", parse_mode='HTML')
+    except api.ApiError as e:
+        logger.warning(f"Ошибка при получении квитанции: {e}")
         await update.message.reply_text("<b>❌ Произошла ошибка при обработке запроса.</b>\n└ Пожалуйста, попробуйте снова.", parse_mode='HTML')
 
     await account_info(update,context)
     return ConversationHandler.END
 
+@timed_handler
+async def send_year_receipts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+
+    user_id = update.effective_user.id
+    auth_token, personal_account_id = await token_store.get_credentials(user_id)
+    selected_year = context.user_data.get('selected_year')
+
+    await query.edit_message_text(f"*✨ Квитанции*\n└ Собираю квитанции за {selected_year} год, это может занять некоторое время.", parse_mode='MARKDOWN')
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            zip_path, included, failed = await export_year(auth_token, personal_account_id, selected_year, directory)
+            if zip_path:
+                caption = f"Квитанции за {selected_year} год: {len(included)} шт."
+                if failed:
+                    caption += f"\nНе удалось получить за месяцы: {', '.join(f'{month:02d}' for month in failed)}"
+                archive = await asyncio.to_thread(open, zip_path, 'rb')
+                with archive:
+                    await context.bot.send_document(chat_id=update.effective_chat.id, document=archive, filename=f"receipts-{selected_year}.zip", caption=caption)
+            else:
+                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data='start')],]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                await query.edit_message_text(f"*❌ Квитанции*\n└ Квитанции за {selected_year} год недоступны, попробуйте позже.", parse_mode='MARKDOWN', reply_markup=reply_markup)
+                return ConversationHandler.END
+    except api.ApiError as e:
+        logger.warning(f"Ошибка при выгрузке квитанций за год: {e}")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="<b>❌ Произошла ошибка при обработке запроса.</b>\n└ Пожалуйста, попробуйте снова.", parse_mode='HTML')
+
+    await account_info(update, context)
+    return ConversationHandler.END
+
+@timed_handler
 async def show_counters(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
 
     user_id = update.effective_user.id
-    auth_token = get_token(user_id)
+    auth_token = await token_store.get_token(user_id)
 
     if not auth_token:
         await query.edit_message_text("*❌ Ваша авторизация не завершена.*\n└ Пожалуйста, пройдите процесс авторизации.", parse_mode='MARKDOWN')
         return ConversationHandler.END
 
-    headers = {
-        'X-Auth-Tenant-Token': f'{auth_token}',
-        'Content-Type': 'application/json'
-    }
-
     # Получаем configurationItemId из контекста
-    response = requests.get(CLIENTS_CONFIGURATION_ITEMS_URL, headers=headers)
-    if response.status_code == 200:
-        data = response.json()
-        items = data.get('items', [])
-        
-        if items:
-            # Предполагаем, что первый элемент в списке items содержит нужный id
-            configuration_item_id = items[0].get('id')
+    configuration_item_id = None
+    try:
+        response = await api.get_configuration_items(auth_token)
+        if response.status_code == 200:
+            data = response.json()
+            items = data.get('items', [])
+
+            if items:
+                # Предполагаем, что первый элемент в списке items содержит нужный id
+                configuration_item_id = items[0].get('id')
+            else:
+                logger.warning("Нет элементов в ответе")
         else:
-            print("Нет элементов в ответе")
-    else:
-        print(f"Ошибка при запросе: {response.status_code}")
+            logger.warning(f"Ошибка при запросе: {response.status_code}")
+
+        if configuration_item_id:
+            meters_response = await api.get_meters_for_item(auth_token, configuration_item_id)
+    except api.ApiError as e:
+        logger.warning(f"Ошибка при получении данных о счётчиках: {e}")
+        await query.edit_message_text("*❌ Не удалось получить данные о счётчиках.*", parse_mode='MARKDOWN')
+        return ConversationHandler.END
 
     if not configuration_item_id:
         await query.edit_message_text("*❌ Не удалось найти идентификатор конфигурационного элемента.*", parse_mode='MARKDOWN')
         return ConversationHandler.END
 
-    meters_url = f"https://nvs.domopult.ru/api/api/clients/meters/for-item/{configuration_item_id}"
-    meters_response = requests.get(meters_url, headers=headers)
-
     if meters_response.status_code == 200:
         meters_data = meters_response.json()
+        await reading_store.record_fetched(user_id, meters_data)
         meters_info = ""
         keyboard = []
         for meter in meters_data:
@@ -623,6 +695,9 @@ async def show_counters(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
                 last_value = meter.get('meter', {}).get('lastValue', {}).get('total', {}).get('displayValue', 'Нет данных')
                 meters_info += f"<b>{meter_type}:</b> {meter_number} - Последнее, общее показание: {last_value}\n"
                 keyboard.append([InlineKeyboardButton(f"⏱️ Внести показания для {meter_type}", callback_data=f"meter_{meter['meter']['id']}")])
+        if len(keyboard) > 1:
+            keyboard.append([InlineKeyboardButton("📝 Внести показания всех счётчиков", callback_data="submit_all_meters")])
+        keyboard.append([InlineKeyboardButton("📈 Расход по месяцам", callback_data="consumption")])
         keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="start")])
 
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -632,6 +707,7 @@ async def show_counters(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await query.edit_message_text("*❌ Не удалось получить данные о счётчиках.*", parse_mode='MARKDOWN')
         return ConversationHandler.END
 
+@timed_handler
 async def select_meter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -641,18 +717,19 @@ async def select_meter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
     # Получаем информацию о счётчике
     user_id = update.effective_user.id
-    auth_token = get_token(user_id)
-    headers = {
-        'X-Auth-Tenant-Token': f'{auth_token}',
-        'Content-Type': 'application/json'
-    }
+    auth_token = await token_store.get_token(user_id)
 
-    meters_url = f"https://nvs.domopult.ru/api/api/clients/meters/{meter_id}"
-    meters_response = requests.get(meters_url, headers=headers)
+    try:
+        meters_response = await api.get_meter(auth_token, meter_id)
+    except api.ApiError as e:
+        logger.warning(f"Ошибка при получении данных о счётчике: {e}")
+        await query.edit_message_text("*❌ Не удалось получить данные о счётчике.*", parse_mode='MARKDOWN')
+        return ConversationHandler.END
 
     if meters_response.status_code == 200:
         meter_data = meters_response.json()
         meter_type = meter_data.get('meter', {}).get('type', 'Неизвестный тип')
+        context.user_data['selected_meter_label'] = f"{meter_type} {meter_data.get('meter', {}).get('number', meter_id)}"
 
         if meter_type == 'Electricity':
             await query.edit_message_text("*📊 Счётчики.*\n└ Пожалуйста, введите показания счётчика (T1, T2, T3):", parse_mode='MARKDOWN')
@@ -667,6 +744,17 @@ async def select_meter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         await query.edit_message_text("*❌ Не удалось получить данные о счётчике.*", parse_mode='MARKDOWN')
         return ConversationHandler.END
 
+async def enqueue_readings(update: Update, context: ContextTypes.DEFAULT_TYPE, meter_id, values: list) -> None:
+    # Показания сначала сохраняются в очередь и отправляются в фоне, о результате бот сообщит отдельно
+    label = context.user_data.pop('selected_meter_label', None)
+    added = await outbox_store.enqueue(update.effective_user.id, update.effective_chat.id, meter_id, label, values)
+    if added:
+        schedule_delivery(context.job_queue)
+        await update.message.reply_text("*✅ Счётчики.*\n└ Показания приняты и будут переданы в domopult, о результате я сообщу.", parse_mode='MARKDOWN')
+    else:
+        await update.message.reply_text("*✅ Счётчики.*\n└ Эти показания уже приняты в этом месяце.", parse_mode='MARKDOWN')
+
+@timed_handler
 async def input_reading(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_input = update.message.text
     meter_id = context.user_data.get('selected_meter_id')
@@ -676,27 +764,10 @@ async def input_reading(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await update.message.reply_text("*❌ Счётчики.*\n└ Показания должны содержать точку. Пожалуйста, введите показания снова.", parse_mode='MARKDOWN')
         return INPUT_READING
 
-    user_id = update.effective_user.id
-    auth_token = get_token(user_id)
-
-    headers = {
-        'X-Auth-Tenant-Token': f'{auth_token}',
-        'Content-Type': 'application/json'
-    }
-
-    payload = {
-        "value1": reading
-    }
-
-    response = requests.post(f"https://nvs.domopult.ru/api/api/clients/meters/{meter_id}/values?withOptionalCheck=true", headers=headers, json=payload)
-
-    if response.status_code == 200:
-        await update.message.reply_text("*✅ Счётчики.*\n└ Показания успешно внесены.", parse_mode='MARKDOWN')
-    else:
-        await update.message.reply_text("*❌ Счётчики.*\n└ Не удалось внести показания.", parse_mode='MARKDOWN')
-
+    await enqueue_readings(update, context, meter_id, [reading])
     return ConversationHandler.END
 
+@timed_handler
 async def input_readings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_input = update.message.text
     meter_id = context.user_data.get('selected_meter_id')
@@ -711,32 +782,259 @@ async def input_readings(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text("*❌ Счётчики.*\n└ Показания должны содержать точку. Пожалуйста, введите показания снова.", parse_mode='MARKDOWN')
             return INPUT_READINGS
 
-    user_id = update.effective_user.id
-    auth_token = get_token(user_id)
+    await enqueue_readings(update, context, meter_id, [reading.strip() for reading in readings])
+    return ConversationHandler.END
 
-    headers = {
-        'X-Auth-Tenant-Token': f'{auth_token}',
-        'Content-Type': 'application/json'
-    }
+async def fetch_meters(auth_token: str) -> list | None:
+    # Ответ meters/for-item первого помещения пользователя; оба запроса обычно берутся из кеша
+    response = await api.get_configuration_items(auth_token)
+    items = response.json().get('items', []) if response.status_code == 200 else []
+    if not items:
+        return None
+    meters_response = await api.get_meters_for_item(auth_token, items[0].get('id'))
+    return meters_response.json() if meters_response.status_code == 200 else None
+
+@timed_handler
+async def ask_all_readings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
 
-    payload = {
-        "value1": readings[0].strip(),
-        "value2": readings[1].strip(),
-        "value3": readings[2].strip()
-    }
+    user_id = update.effective_user.id
+    auth_token = await token_store.get_token(user_id)
 
-    response = requests.post(f"https://nvs.domopult.ru/api/api/clients/meters/{meter_id}/values?withOptionalCheck=true", headers=headers, json=payload)
+    try:
+        meters_data = await fetch_meters(auth_token) if auth_token else None
+    except api.ApiError as e:
+        logger.warning(f"Ошибка при получении данных о счётчиках: {e}")
+        meters_data = None
+    meters = meter_summary(meters_data) if meters_data else []
+    if not meters:
+        await query.edit_message_text("*❌ Не удалось получить данные о счётчиках.*", parse_mode='MARKDOWN')
+        return ConversationHandler.END
+    await reading_store.record_fetched(user_id, meters_data)
 
-    if response.status_code == 200:
-        await update.message.reply_text("*✅ Счётчики.*\n└ Показания успешно внесены.", parse_mode='MARKDOWN')
-    else:
-        await update.message.reply_text("*❌ Счётчики.*\n└ Не удалось внести показания.", parse_mode='MARKDOWN')
+    # Последние значения нужны для проверки введенных показаний без повторного запроса
+    context.user_data['batch_meters'] = meters
+    lines = [
+        f"{html.escape(str(number))}: {'T1, T2, T3' if meter_type == 'Electricity' else format_number(last_value)}"
+        for _, meter_type, number, last_value in meters
+    ]
+    await query.edit_message_text(
+        "<b>📝 Показания всех счётчиков</b>\n"
+        "└ Отправьте одним сообщением по строке на счётчик, показания - с точкой. "
+        "Счётчики, показания которых передавать не нужно, можно пропустить:\n"
+        f"<pre>{chr(10).join(lines)}</pre>",
+        parse_mode='HTML'
+    )
+    return INPUT_ALL_READINGS
+
+@timed_handler
+async def input_all_readings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    meters = context.user_data.get('batch_meters', [])
+    values, errors = parse_batch(update.message.text, meters)
 
+    if errors or not values:
+        details = '\n'.join(f"• {html.escape(error)}" for error in errors) or "• не найдено ни одного показания"
+        await update.message.reply_text(
+            f"<b>❌ Счётчики.</b>\n{details}\n└ Пожалуйста, отправьте показания снова.", parse_mode='HTML'
+        )
+        return INPUT_ALL_READINGS
+
+    # Как и одиночные показания, все уходят через очередь: ответ не ждет domopult,
+    # а при сбоях показания отправляются повторно в фоне
+    user_id, chat_id = update.effective_user.id, update.effective_chat.id
+    lines, added_any = [], False
+    for meter_id, meter_type, number, _ in meters:
+        if meter_id not in values:
+            continue
+        added = await outbox_store.enqueue(user_id, chat_id, meter_id, f"{meter_type} {number}", values[meter_id])
+        added_any = added_any or added
+        status = "⏳" if added else "✅ уже приняты в этом месяце,"
+        lines.append(f"{status} <b>{meter_type}</b> {html.escape(str(number))}: {', '.join(values[meter_id])}")
+    if added_any:
+        schedule_delivery(context.job_queue)
+    context.user_data.pop('batch_meters', None)
+    await update.message.reply_text(
+        "<b>📊 Счётчики.</b>\n" + '\n'.join(lines)
+        + ("\n└ Показания приняты и будут переданы в domopult, о результате я сообщу." if added_any else "\n└ Новых показаний нет."),
+        parse_mode='HTML'
+    )
     return ConversationHandler.END
 
-def main() -> None:
-    init_db()
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+@timed_handler
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("Использование: /broadcast текст сообщения")
+        return
+    # Ключ по update_id: повторная доставка той же команды не создаст вторую рассылку
+    broadcast_id = await start_broadcast(f"manual-{update.update_id}", parts[1], update.effective_user.id)
+    if broadcast_id is not None:
+        context.job_queue.run_once(broadcast_job, 0, name='broadcast_now')
+        await update.message.reply_text(f"📣 Рассылка #{broadcast_id} запущена, по завершении придет отчет. Ход: /broadcast_status")
+
+@timed_handler
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    summaries = await broadcast_store.recent(5)
+    text = '\n\n'.join(format_summary(summary) for summary in summaries) or "Рассылок еще не было."
+    await update.message.reply_text(text)
+
+@timed_handler
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /broadcast_cancel номер_рассылки")
+        return
+    cancelled = await broadcast_store.cancel(int(context.args[0]))
+    await update.message.reply_text("Рассылка отменена." if cancelled else "Рассылка не найдена или уже отменена.")
+
+@timed_handler
+async def show_consumption(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+
+    # История берется только из локальной базы, к domopult не обращаемся
+    series = await reading_store.consumption(update.effective_user.id)
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🧭 Счётчики", callback_data='counters')],
+        [InlineKeyboardButton("🔙 Назад", callback_data='start')],
+    ])
+    if not series:
+        await query.edit_message_text("*📈 Расход.*\n└ История показаний пока пуста.", parse_mode='MARKDOWN', reply_markup=keyboard)
+        return
+
+    lines = ["<b>📈 Расход по месяцам</b>"]
+    for entry in series:
+        lines.append(f"\n<b>{entry['meter_type']}</b> {html.escape(str(entry['number'] or ''))} ({TARIFF_NAMES.get(entry['tariff'], entry['tariff'])})")
+        # Уменьшение показания (замена счётчика, ошибка ввода) в среднее не входит
+        deltas = [delta for _, _, delta, _, _, _ in entry['months'] if delta is not None and delta >= 0]
+        for month, value, delta, gap, _, anomaly in entry['months']:
+            line = f"{month}: {format_number(value)}"
+            if delta is not None:
+                line += f" (+{format_number(delta)}" if delta >= 0 else f" ({format_number(delta)}"
+                # Пропущенные месяцы: расход показан в среднем за месяц
+                line += f" в месяц за {gap} мес.)" if gap > 1 else ")"
+            if anomaly:
+                line += " ⚠️"
+            lines.append(line)
+        if deltas:
+            lines.append(f"Средний расход: {format_number(sum(deltas) / len(deltas))} в месяц")
+    lines.append("\n⚠️ - расход намного выше среднего или показание уменьшилось.")
+    await query.edit_message_text('\n'.join(lines), parse_mode='HTML', reply_markup=keyboard)
+
+@timed_handler
+async def show_payment_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+
+    page = int(query.data.split('_')[1])
+    auth_token, personal_account_id = await token_store.get_credentials(update.effective_user.id)
+    if not auth_token or not personal_account_id:
+        await query.edit_message_text("*❌ Ваша авторизация не завершена.*\n└ Пожалуйста, пройдите процесс авторизации.", parse_mode='MARKDOWN')
+        return
+
+    notice = ""
+    if page == 0:
+        # Новые платежи догружаются при открытии истории, листание идет только по локальной базе
+        try:
+            await sync_payments(auth_token, personal_account_id)
+        except api.ApiError as e:
+            logger.warning(f"Не удалось синхронизировать историю платежей: {e}")
+            notice = "\n<i>Не удалось обновить историю, показаны сохраненные данные.</i>"
+
+    rows, total = await payment_store.page(personal_account_id, page * PAYMENT_HISTORY_PAGE_SIZE, PAYMENT_HISTORY_PAGE_SIZE)
+    pages = max(1, -(-total // PAYMENT_HISTORY_PAGE_SIZE))
+    lines = [f"<b>📜 История платежей</b> (страница {page + 1} из {pages}, всего {total})"]
+    for creation_date, payment_sum, status, payment_type, service_type in rows:
+        date = dateutil_parser.isoparse(creation_date).strftime('%d.%m.%Y') if creation_date else '—'
+        lines.append(f"{date}: <b>{format_number(payment_sum)} ₽</b> — {html.escape(str(service_type))}, {html.escape(str(payment_type))}, {html.escape(str(status))}")
+    if not rows:
+        lines.append("Платежей нет.")
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️", callback_data=f'history_{page - 1}'))
+    if page + 1 < pages:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=f'history_{page + 1}'))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='start')])
+    await query.edit_message_text('\n'.join(lines) + notice, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def load_account_session(user_id) -> AccountSession | None:
+    auth_token, personal_account_id = await token_store.get_credentials(user_id)
+    if not auth_token or not personal_account_id:
+        return None
+    try:
+        response = await api.get_payments(auth_token, personal_account_id)
+    except api.ApiError as e:
+        logger.warning(f"Не удалось загрузить данные личного кабинета: {e}")
+        return None
+    return response.json() if response.status_code == 200 else None
+
+async def evict_sessions_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    evict_idle_sessions(context.application, 'account', SESSION_IDLE_TTL)
+
+async def on_startup(application: Application) -> None:
+    token_store.open()
+    receipt_store.open()
+    reading_store.open()
+    payment_store.open()
+    outbox_store.open()
+    broadcast_store.open()
+    watch_store.open()
+    api.init_client()
+    if METRICS_PORT:
+        # Порт METRICS_PORT занимает приемник, обработчики отдают метрики на следующих портах
+        port = METRICS_PORT if cluster.shard is None else METRICS_PORT + 1 + cluster.shard[0]
+        application.bot_data['metrics_server'] = await metrics.start_server(METRICS_LISTEN, port)
+    if PREWARM_INTERVAL and application.job_queue is not None:
+        # Первый запуск со случайной задержкой, чтобы перезапуски не совпадали с началом окна
+        application.job_queue.run_repeating(
+            prewarm.prewarm_job, interval=PREWARM_INTERVAL, first=random.uniform(60, 300), name='prewarm',
+        )
+    if application.job_queue is not None:
+        # Первый проход сразу отправляет показания, оставшиеся в очереди с прошлого запуска
+        application.job_queue.run_repeating(outbox_job, interval=OUTBOX_INTERVAL, first=1, name='outbox')
+    if application.job_queue is not None:
+        # Незавершенные рассылки продолжаются после перезапуска с сохраненного места
+        application.job_queue.run_repeating(broadcast_job, interval=BROADCAST_POLL_INTERVAL, first=10, name='broadcast')
+    if READING_REMINDER_DAY and application.job_queue is not None:
+        reminder_time = dt_time(*READING_REMINDER_TIME, tzinfo=datetime.now().astimezone().tzinfo)
+        application.job_queue.run_monthly(reading_reminder_job, when=reminder_time, day=READING_REMINDER_DAY, name='reading_reminder')
+    if WATCH_TICK and application.job_queue is not None:
+        application.job_queue.run_repeating(watch_job, interval=WATCH_TICK, first=random.uniform(5, WATCH_TICK), name='watch')
+    if SESSION_EVICT_INTERVAL and application.job_queue is not None:
+        application.job_queue.run_repeating(evict_sessions_job, interval=SESSION_EVICT_INTERVAL, name='evict_sessions')
+
+async def on_shutdown(application: Application) -> None:
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await api.close_client()
+    await prewarm.activity.flush()
+    token_store.close()
+    receipt_store.close()
+    reading_store.close()
+    payment_store.close()
+    outbox_store.close()
+    broadcast_store.close()
+    watch_store.close()
+    if application.persistence is not None:
+        application.persistence.store.close()
+
+def build_application(bot_request: BaseRequest | None = None) -> Application:
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .persistence(SqlitePersistence(shard=cluster.shard))
+    )
+    if bot_request is not None:
+        # Подмена Bot API, используется бенчмарками
+        builder = builder.request(bot_request).get_updates_request(bot_request)
+    application = builder.build()
 
     conversation_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -747,37 +1045,80 @@ def main() -> None:
             PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, password)],
             SMS_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, sms_code)],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='login',
+        persistent=True,
     )
 
     conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(ask_for_year, pattern='^download_receipt$')],
         states={
             SELECT_YEAR: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_year_input)],
-            SELECT_MONTH: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_month_input)],
+            SELECT_MONTH: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_month_input),
+                CallbackQueryHandler(send_year_receipts, pattern='^receipt_year$'),
+            ],
         },
         fallbacks=[],
+        name='receipt',
+        persistent=True,
     )
 
     meter_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(show_counters, pattern='^counters$')],
         states={
-            SELECT_METER: [CallbackQueryHandler(select_meter, pattern='^meter_')],
+            SELECT_METER: [
+                CallbackQueryHandler(select_meter, pattern='^meter_'),
+                CallbackQueryHandler(ask_all_readings, pattern='^submit_all_meters$'),
+            ],
             INPUT_READING: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_reading)],
             INPUT_READINGS: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_readings)],
+            INPUT_ALL_READINGS: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_all_readings)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='meter',
+        persistent=True,
     )
 
+    # Отмечаем активность до всех остальных обработчиков; группа -1 не мешает их выбору
+    application.add_handler(TypeHandler(Update, prewarm.track_activity), group=-1)
     application.add_handler(conversation_handler)
     application.add_handler(conv_handler)
     application.add_handler(meter_handler)
     application.add_handler(CallbackQueryHandler(show_counters, pattern='^counters$'))
-    application.add_handler(CallbackQueryHandler(detailed_info_handler, pattern='^detailed_info$'))
+    application.add_handler(CallbackQueryHandler(detailed_info_handler, pattern=r'^detailed_info(_\d+)?$'))
+    application.add_handler(CallbackQueryHandler(show_consumption, pattern='^consumption$'))
+    application.add_handler(CallbackQueryHandler(show_payment_history, pattern=r'^history_\d+$'))
     application.add_handler(CallbackQueryHandler(start, pattern='^start$'))
+    application.add_handler(CallbackQueryHandler(refresh_account_info, pattern='^refresh$'))
     application.add_handler(CallbackQueryHandler(top_up_balance, pattern='^top_up_balance$'))
+    application.add_handler(CallbackQueryHandler(toggle_watch, pattern='^watch_toggle$'))
+    admins = filters.User(user_id=list(ADMIN_IDS))
+    application.add_handler(CommandHandler('broadcast', broadcast_command, filters=admins))
+    application.add_handler(CommandHandler('broadcast_status', broadcast_status, filters=admins))
+    application.add_handler(CommandHandler('broadcast_cancel', broadcast_cancel, filters=admins))
+    return application
+
+def main() -> None:
+    print(ascii_art)
+    if CLUSTER_WORKERS:
+        # Приемник вебхука и процессы-обработчики, каждый со своим приложением
+        cluster.run(build_application)
+        return
 
-    application.run_polling()
+    application = build_application()
+
+    if BOT_MODE == 'webhook':
+        # Встроенный HTTP-сервер принимает обновления от Telegram через обратный прокси
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL or None,
+            secret_token=WEBHOOK_SECRET or None,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,203 @@
+import asyncio
+import functools
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, labelvalues, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.register(self)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self) -> list:
+        lines = self.header()
+        for labelvalues, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labelvalues, amount: float = 1) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, *labelvalues, value: float) -> None:
+        self._values[labelvalues] = value
+
+
+class GaugeFunc(_Metric):
+    """Значения считываются в момент выдачи метрик: callback возвращает
+    словарь {кортеж значений меток: число}."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self) -> list:
+        lines = self.header()
+        for labelvalues, value in self.callback().items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class CounterFunc(GaugeFunc):
+    kind = 'counter'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, *labelvalues, value: float) -> None:
+        state = self._values.get(labelvalues)
+        if state is None:
+            state = self._values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+        counts = state[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> list:
+        lines = self.header()
+        for labelvalues, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> None:
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f"Не удалось собрать метрику {metric.name}: {e!r}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+# Метрики бота
+HANDLER_LATENCY = Histogram('nvbq_handler_duration_seconds', 'Время работы обработчика', ('handler',))
+HANDLER_ERRORS = Counter('nvbq_handler_errors_total', 'Исключения в обработчиках', ('handler',))
+UPSTREAM_LATENCY = Histogram('nvbq_upstream_duration_seconds', 'Время запроса к domopult', ('method', 'endpoint'))
+UPSTREAM_RESPONSES = Counter('nvbq_upstream_responses_total', 'Ответы domopult по кодам', ('method', 'endpoint', 'status'))
+SQLITE_LATENCY = Histogram(
+    'nvbq_sqlite_duration_seconds', 'Время запроса к SQLite, включая ожидание потока хранилища', ('store', 'operation'),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+UPDATES_IN_FLIGHT = Gauge('nvbq_updates_in_flight', 'Обновления, которые сейчас обрабатываются')
+UPDATES_WAITING = Gauge('nvbq_updates_waiting', 'Обновления, ждущие своей очереди у пользователя')
+
+
+def register_cache(name: str, cache) -> None:
+    # Счетчики попаданий берутся прямо из объекта кеша в момент выдачи метрик
+    CounterFunc(
+        f'nvbq_{name}_cache_requests_total', f'Обращения к кешу {name}',
+        lambda: {('hit',): cache.hits, ('miss',): cache.misses}, ('result',),
+    )
+    GaugeFunc(f'nvbq_{name}_cache_entries', f'Записей в кеше {name}', lambda: {(): len(cache)})
+
+
+def timed_handler(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(name, value=time.perf_counter() - started)
+    return wrapper
+
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Заголовки запроса не нужны, но их нужно дочитать
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', REGISTRY.render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> asyncio.AbstractServer:
+    return await asyncio.start_server(_handle_connection, host, port)
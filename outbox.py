@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import html
+import json
+import logging
+import time
+from telegram.error import TelegramError
+from telegram.ext import ContextTypes
+import api
+import cluster
+import metrics
+from policy import backoff_delay
+from readings import reading_store
+from storage import SqliteStore, token_store
+from config import (
+    OUTBOX_BATCH, OUTBOX_CONCURRENCY, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BACKOFF, OUTBOX_RETRY_MAX_DELAY,
+)
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DELIVERIES = metrics.Counter('nvbq_outbox_deliveries_total', 'Попытки отправки показаний из очереди по результату', ('result',))
+
+# Сколько хранить отправленные и отклоненные показания, секунды
+KEEP_FINISHED = 30 * 86400
+
+
+def idempotency_key(telegram_id, meter_id, values: list, period: str) -> str:
+    # Одинаковые показания одного счётчика за один расчетный месяц - одна запись в очереди.
+    # Те же значения в следующем месяце (счётчиком не пользовались) передаются заново
+    return hashlib.sha256(json.dumps([telegram_id, int(meter_id), values, period]).encode()).hexdigest()[:32]
+
+
+class OutboxStore(SqliteStore):
+    """Очередь показаний счётчиков, ожидающих отправки в domopult.
+
+    Запись со статусом pending отправляется в фоне, пока не будет принята
+    (sent) или отклонена окончательно (failed). Ключ записи одновременно
+    служит ключом идемпотентности запроса к domopult.
+    """
+
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS reading_outbox (
+            idempotency_key TEXT PRIMARY KEY,
+            telegram_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            meter_id INTEGER NOT NULL,
+            label TEXT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            last_error TEXT
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS reading_outbox_due ON reading_outbox (status, next_attempt_at)',
+    )
+
+    # Отклоненные показания можно передать повторно, принятые и ожидающие - нет
+    ENQUEUE_SQL = '''
+        INSERT INTO reading_outbox
+            (idempotency_key, telegram_id, chat_id, meter_id, label, payload, status, attempts, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, 'pending', 0, ?, ?)
+        ON CONFLICT (idempotency_key) DO UPDATE SET
+            status = 'pending', attempts = 0, chat_id = excluded.chat_id,
+            next_attempt_at = excluded.next_attempt_at, last_error = NULL
+        WHERE status = 'failed'
+    '''
+    DUE_SQL = '''
+        SELECT idempotency_key, telegram_id, chat_id, meter_id, label, payload, attempts FROM reading_outbox
+        WHERE status = 'pending' AND next_attempt_at <= ? AND telegram_id % ? = ?
+        ORDER BY next_attempt_at
+        LIMIT ?
+    '''
+    RETRY_SQL = 'UPDATE reading_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE idempotency_key = ?'
+    FINISH_SQL = 'UPDATE reading_outbox SET status = ?, attempts = ?, last_error = ? WHERE idempotency_key = ?'
+    PRUNE_SQL = "DELETE FROM reading_outbox WHERE status != 'pending' AND next_attempt_at < ?"
+
+    async def enqueue(self, telegram_id, chat_id, meter_id, label: str, values: list) -> bool:
+        # False - такие показания уже ждут отправки или приняты в этом месяце
+        now = time.time()
+        period = time.strftime('%Y-%m', time.localtime(now))
+        payload = json.dumps({f"value{index}": value for index, value in enumerate(values, 1)})
+        changed = await self.execute(self.ENQUEUE_SQL, (
+            idempotency_key(telegram_id, meter_id, values, period), telegram_id, chat_id, int(meter_id), label, payload, now, now,
+        ))
+        return changed > 0
+
+    async def due(self, limit: int, shard: tuple | None = None) -> list:
+        # shard - (номер, число) процессов-обработчиков: каждый отправляет показания своих пользователей
+        index, count = shard or (0, 1)
+        return await self.fetchall(self.DUE_SQL, (time.time(), count, index, limit))
+
+    async def retry(self, key: str, attempts: int, delay: float, error: str) -> None:
+        await self.execute(self.RETRY_SQL, (attempts, time.time() + delay, error, key))
+
+    async def finish(self, key: str, status: str, attempts: int, error: str | None = None) -> None:
+        await self.execute(self.FINISH_SQL, (status, attempts, error, key))
+
+    async def prune(self, before: float) -> int:
+        return await self.execute(self.PRUNE_SQL, (before,))
+
+
+outbox_store = OutboxStore()
+
+_running = asyncio.Lock()
+_pruned_at = 0.0
+
+
+async def _notify(bot, chat_id, text: str) -> None:
+    try:
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
+    except TelegramError as e:
+        logger.warning(f"Не удалось сообщить о передаче показаний в чат {chat_id}: {e}")
+
+
+async def _deliver(bot, entry) -> str:
+    key, telegram_id, chat_id, meter_id, label, payload, attempts = entry
+    attempts += 1
+    values = list(json.loads(payload).values())
+    description = f"счётчика {html.escape(label or str(meter_id))} ({html.escape(', '.join(values))})"
+
+    auth_token = await token_store.get_token(telegram_id)
+    if auth_token is None:
+        await outbox_store.finish(key, 'failed', attempts, 'нет авторизации')
+        await _notify(bot, chat_id, f"<b>❌ Счётчики.</b>\n└ Показания {description} не переданы: авторизуйтесь заново и внесите их снова.")
+        return 'unauthorized'
+
+    try:
+        response = await api.post_meter_values(auth_token, meter_id, json.loads(payload), key)
+        error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+        # Ошибки domopult и превышение лимита - временные, остальные ответы окончательные
+        retryable = response.status_code >= 500 or response.status_code == 429
+    except api.ApiError as e:
+        error, retryable = str(e), True
+
+    if error is None:
+        await outbox_store.finish(key, 'sent', attempts)
+        await reading_store.record_submitted(meter_id, values)
+        await _notify(bot, chat_id, f"<b>✅ Счётчики.</b>\n└ Показания {description} внесены.")
+        return 'sent'
+    if retryable and attempts < OUTBOX_MAX_ATTEMPTS:
+        delay = min(OUTBOX_RETRY_BACKOFF * 2 ** (attempts - 1) + backoff_delay(0, OUTBOX_RETRY_BACKOFF), OUTBOX_RETRY_MAX_DELAY)
+        await outbox_store.retry(key, attempts, delay, error)
+        return 'retry'
+    logger.warning(f"Показания счётчика {meter_id} не переданы после {attempts} попыток: {error}")
+    await outbox_store.finish(key, 'failed', attempts, error)
+    await _notify(bot, chat_id, f"<b>❌ Счётчики.</b>\n└ Не удалось внести показания {description}. Пожалуйста, попробуйте позже.")
+    return 'failed'
+
+
+async def deliver_pending(bot) -> dict:
+    """Отправляет в domopult показания из очереди, срок отправки которых наступил.
+
+    Возвращает число показаний по результатам отправки.
+    """
+    entries = await outbox_store.due(OUTBOX_BATCH, cluster.shard)
+    semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    results = {}
+
+    async def deliver(entry):
+        async with semaphore:
+            result = await _deliver(bot, entry)
+        OUTBOX_DELIVERIES.inc(result)
+        results[result] = results.get(result, 0) + 1
+
+    await asyncio.gather(*(deliver(entry) for entry in entries))
+    return results
+
+
+async def outbox_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    global _pruned_at
+    # Запуск сразу после постановки в очередь может совпасть с плановым
+    if _running.locked():
+        return
+    async with _running:
+        results = await deliver_pending(context.bot)
+        if time.time() - _pruned_at > 3600:
+            _pruned_at = time.time()
+            await outbox_store.prune(time.time() - KEEP_FINISHED)
+    if results:
+        logger.info(f"Отправка показаний из очереди: {results}")
+
+
+def schedule_delivery(job_queue) -> None:
+    # Не ждем планового запуска, чтобы показания ушли сразу
+    if job_queue is not None:
+        job_queue.run_once(outbox_job, 0, name='outbox_now')
@@ -0,0 +1,134 @@
+import time
+import api
+from config import PAYMENT_SYNC_PAGE_SIZE, PAYMENT_SYNC_INTERVAL
+from storage import SqliteStore
+
+
+class PaymentStore(SqliteStore):
+    """Локальная копия истории платежей по лицевым счетам."""
+
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            personal_account_id TEXT NOT NULL,
+            payment_id INTEGER NOT NULL,
+            creation_date TEXT,
+            status TEXT,
+            payment_type TEXT,
+            service_type TEXT,
+            payment_sum REAL,
+            PRIMARY KEY (personal_account_id, payment_id)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS payments_by_date ON payments (personal_account_id, creation_date DESC, payment_id DESC)',
+        '''
+        CREATE TABLE IF NOT EXISTS payment_sync (
+            personal_account_id TEXT PRIMARY KEY,
+            complete INTEGER NOT NULL,
+            synced_at REAL NOT NULL
+        )
+        ''',
+    )
+
+    # Статус и сумма платежа могут измениться после первой загрузки (платеж был
+    # в обработке), поэтому известные платежи обновляются, если что-то поменялось
+    SAVE_SQL = '''
+        INSERT INTO payments
+            (personal_account_id, payment_id, creation_date, status, payment_type, service_type, payment_sum)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (personal_account_id, payment_id) DO UPDATE SET
+            creation_date = excluded.creation_date, status = excluded.status, payment_type = excluded.payment_type,
+            service_type = excluded.service_type, payment_sum = excluded.payment_sum
+        WHERE (creation_date, status, payment_type, service_type, payment_sum)
+            IS NOT (excluded.creation_date, excluded.status, excluded.payment_type, excluded.service_type, excluded.payment_sum)
+    '''
+    GET_STATE_SQL = 'SELECT complete, synced_at FROM payment_sync WHERE personal_account_id = ?'
+    SET_STATE_SQL = 'INSERT OR REPLACE INTO payment_sync (personal_account_id, complete, synced_at) VALUES (?, ?, ?)'
+    PAGE_SQL = '''
+        SELECT creation_date, payment_sum, status, payment_type, service_type FROM payments
+        WHERE personal_account_id = ?
+        ORDER BY creation_date DESC, payment_id DESC
+        LIMIT ? OFFSET ?
+    '''
+    COUNT_SQL = 'SELECT COUNT(*) FROM payments WHERE personal_account_id = ?'
+
+    def _sync_save_payments(self, personal_account_id: str, results: list) -> int:
+        # Возвращает число новых платежей; изменения уже известных в него не входят
+        rows = [
+            (
+                personal_account_id, result.get('id'), result.get('creationDate'), result.get('status'),
+                result.get('paymentType'), result.get('serviceType'), result.get('paymentSum'),
+            )
+            for result in results if result.get('id') is not None
+        ]
+        if not rows:
+            return 0
+        conn = self._connect()
+        with conn:
+            known = conn.execute(
+                f"SELECT COUNT(*) FROM payments WHERE personal_account_id = ? AND payment_id IN ({', '.join('?' * len(rows))})",
+                (personal_account_id, *(row[1] for row in rows)),
+            ).fetchone()[0]
+            conn.executemany(self.SAVE_SQL, rows)
+        return len(rows) - known
+
+    async def save_payments(self, personal_account_id, results: list) -> int:
+        return await self._run(self._sync_save_payments, str(personal_account_id), results)
+
+    async def get_state(self, personal_account_id) -> tuple:
+        # (полная история уже загружена, время последней синхронизации)
+        row = await self.fetchone(self.GET_STATE_SQL, (str(personal_account_id),))
+        return (bool(row[0]), row[1]) if row else (False, 0.0)
+
+    async def set_state(self, personal_account_id, complete: bool) -> None:
+        await self.execute(self.SET_STATE_SQL, (str(personal_account_id), int(complete), time.time()))
+
+    async def page(self, personal_account_id, offset: int, limit: int) -> tuple:
+        # (платежи страницы, всего платежей)
+        personal_account_id = str(personal_account_id)
+        rows = await self.fetchall(self.PAGE_SQL, (personal_account_id, limit, offset))
+        (total,) = await self.fetchone(self.COUNT_SQL, (personal_account_id,))
+        return rows, total
+
+
+payment_store = PaymentStore()
+
+
+async def _sync(auth_token: str, personal_account_id) -> int:
+    complete, _ = await payment_store.get_state(personal_account_id)
+    added = 0
+    page = 0
+    while True:
+        response = await api.get_payments_page(auth_token, personal_account_id, page, PAYMENT_SYNC_PAGE_SIZE)
+        if response.status_code != 200:
+            raise api.ApiError(f"payments page {page}: {response.status_code}")
+        data = response.json()
+        results = data.get('results', [])
+        new = await payment_store.save_payments(personal_account_id, results)
+        added += new
+        page += 1
+        # Неполная страница - последняя; totalElements есть не во всех ответах и лишь дополняет проверку
+        total = data.get('totalElements')
+        last_page = len(results) < PAYMENT_SYNC_PAGE_SIZE or (total is not None and page * PAYMENT_SYNC_PAGE_SIZE >= total)
+        # Платежи идут от новых к старым: встретив известный, дальше можно не листать,
+        # если вся история уже была загружена раньше
+        if last_page or (complete and new < len(results)):
+            break
+    await payment_store.set_state(personal_account_id, True)
+    return added
+
+
+async def sync_payments(auth_token: str, personal_account_id, force: bool = False) -> int:
+    """Догружает в локальную базу новые платежи счета.
+
+    Первая синхронизация проходит по всем страницам, следующие - только до
+    первой известной страницы. Возвращает число новых платежей.
+    """
+    if not force:
+        complete, synced_at = await payment_store.get_state(personal_account_id)
+        if complete and time.time() - synced_at < PAYMENT_SYNC_INTERVAL:
+            return 0
+    # Одновременные синхронизации одного счета склеиваются в одну
+    return await api.single_flight.do(
+        ('sync_payments', str(personal_account_id)), lambda: _sync(auth_token, personal_account_id)
+    )
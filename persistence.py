@@ -0,0 +1,180 @@
+import asyncio
+import json
+import logging
+import pickle
+from telegram.ext import BasePersistence, PersistenceInput
+from config import DB_PATH, PERSISTENCE_INTERVAL
+from storage import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+# Ключи user_data, которые не должны попадать на диск. Сессия кабинета содержит
+# личные данные и балансы и после перезапуска собирается заново (load_account_session)
+TRANSIENT_KEYS = frozenset({'password', 'account'})
+
+
+class PersistenceStore(SqliteStore):
+    """Таблицы с user_data и состояниями разговоров, по строке на пользователя."""
+
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state BLOB NOT NULL,
+            PRIMARY KEY (name, key)
+        )
+        ''',
+    )
+
+    SAVE_USER_SQL = 'INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)'
+    DROP_USER_SQL = 'DELETE FROM user_data WHERE user_id = ?'
+    SAVE_STATE_SQL = 'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)'
+    DROP_STATE_SQL = 'DELETE FROM conversations WHERE name = ? AND key = ?'
+
+    def _sync_load_user_data(self, index: int, count: int) -> dict:
+        rows = self._connect().execute('SELECT user_id, data FROM user_data WHERE user_id % ? = ?', (count, index))
+        return {user_id: pickle.loads(data) for user_id, data in rows}
+
+    def _sync_load_conversations(self, name: str, index: int, count: int) -> dict:
+        rows = self._connect().execute('SELECT key, state FROM conversations WHERE name = ?', (name,))
+        conversations = {}
+        for key, state in rows:
+            # Последний элемент ключа разговора - id пользователя
+            key = tuple(json.loads(key))
+            if key[-1] % count == index:
+                conversations[key] = pickle.loads(state)
+        return conversations
+
+    def _sync_write_batch(self, users: dict, states: dict) -> None:
+        # Все изменения одного прохода пишутся одной транзакцией;
+        # сериализация тоже здесь, чтобы не занимать цикл событий
+        conn = self._connect()
+        with conn:
+            conn.executemany(self.SAVE_USER_SQL, [
+                (user_id, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+                for user_id, data in users.items() if data is not None
+            ])
+            conn.executemany(self.DROP_USER_SQL, [(user_id,) for user_id, data in users.items() if data is None])
+            conn.executemany(self.SAVE_STATE_SQL, [
+                (name, key, pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+                for (name, key), state in states.items() if state is not None
+            ])
+            conn.executemany(self.DROP_STATE_SQL, [key for key, state in states.items() if state is None])
+
+    async def load_user_data(self, shard: tuple | None = None) -> dict:
+        return await self._run(self._sync_load_user_data, *(shard or (0, 1)))
+
+    async def load_conversations(self, name: str, shard: tuple | None = None) -> dict:
+        return await self._run(self._sync_load_conversations, name, *(shard or (0, 1)))
+
+    async def write_batch(self, users: dict, states: dict) -> None:
+        await self._run(self._sync_write_batch, users, states)
+
+
+class SqlitePersistence(BasePersistence):
+    """Хранение user_data и состояний ConversationHandler в SQLite.
+
+    Application передает сюда только изменившихся пользователей и разговоры.
+    Изменения одного прохода собираются и записываются одной транзакцией,
+    поэтому стоимость сохранения зависит от числа изменившихся пользователей,
+    а не от общего числа пользователей. bot_data и chat_data бот не использует
+    (в bot_data лежат несериализуемые объекты), они не сохраняются.
+    shard - (номер, число) процессов-обработчиков: процесс загружает только
+    данные своих пользователей.
+    """
+
+    def __init__(self, path: str = DB_PATH, update_interval: float = PERSISTENCE_INTERVAL, shard: tuple | None = None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = PersistenceStore(path)
+        self.shard = shard
+        self._users = {}
+        self._states = {}
+        self._batch: asyncio.Task | None = None
+
+    async def _write_pending(self) -> None:
+        # Даем остальным вызовам update_* того же прохода добавить свои изменения
+        await asyncio.sleep(0)
+        self._batch = None
+        users, self._users = self._users, {}
+        states, self._states = self._states, {}
+        if not users and not states:
+            return
+        try:
+            await self.store.write_batch(users, states)
+        except Exception:
+            # Возвращаем несохраненное обратно, более новые изменения важнее
+            self._users = {**users, **self._users}
+            self._states = {**states, **self._states}
+            raise
+
+    async def _schedule_write(self) -> None:
+        if self._batch is None:
+            self._batch = asyncio.create_task(self._write_pending())
+        # Отмена одного вызова не должна отменять запись всей пачки
+        await asyncio.shield(self._batch)
+
+    async def get_user_data(self) -> dict:
+        return await self.store.load_user_data(self.shard)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        for key in TRANSIENT_KEYS & data.keys():
+            del data[key]
+        self._users[user_id] = data
+        await self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._users[user_id] = None
+        await self._schedule_write()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return await self.store.load_conversations(name, self.shard)
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._states[(name, json.dumps(list(key)))] = new_state
+        await self._schedule_write()
+
+    async def flush(self) -> None:
+        if self._batch is not None:
+            await asyncio.shield(self._batch)
+        await self._write_pending()
+
+    # bot_data, chat_data и callback_data не сохраняются
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import random
+import time
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate запросов в секунду с запасом capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RateLimiter:
+    """Общий лимит на все исходящие запросы плюс отдельный лимит на каждого пользователя."""
+
+    def __init__(self, rate: float, burst: float, user_rate: float, user_burst: float, max_users: int = 10000):
+        self.global_bucket = TokenBucket(rate, burst)
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        # Бакеты неактивных пользователей вытесняются; новый бакет стартует полным
+        self._user_buckets = TTLCache(max_users, ttl=max(user_burst / user_rate, 1) * 10)
+
+    async def acquire(self, owner=None) -> None:
+        if owner is not None:
+            bucket = self._user_buckets.get(owner)
+            if bucket is None:
+                bucket = TokenBucket(self.user_rate, self.user_burst)
+            self._user_buckets.set(owner, bucket)
+            await bucket.acquire()
+        await self.global_bucket.acquire()
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold ошибок подряд и пропускает
+    пробный запрос не раньше, чем через reset_timeout секунд.
+
+    Если исход пробного запроса так и не записан (запрос отменен или
+    упал с неожиданным исключением), через reset_timeout пропускается
+    следующий пробный запрос.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if now - self._opened_at >= self.reset_timeout:
+            # Пропускаем один пробный запрос; время пробы отсчитывается заново
+            self.state = self.HALF_OPEN
+            self._opened_at = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.warning("Связь с domopult восстановлена, цепь замкнута")
+        self.state = self.CLOSED
+        self._failures = 0
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"domopult недоступен ({self._failures} ошибок подряд), цепь разомкнута")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+
+def backoff_delay(attempt: int, base: float) -> float:
+    # Экспоненциальная задержка с полным джиттером
+    return random.uniform(0, base * 2 ** attempt)
+
+
+class SingleFlight:
+    """Склеивает одинаковые одновременные вызовы в один.
+
+    Пока вызов с ключом key выполняется, остальные вызовы с тем же ключом
+    ждут его результат вместо того, чтобы повторять запрос.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def _forget(self, key, future: asyncio.Future) -> None:
+        self._calls.pop(key, None)
+        # Помечаем исключение полученным, даже если все ожидающие были отменены
+        if not future.cancelled():
+            future.exception()
+
+    async def do(self, key, factory):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        # Отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(future)
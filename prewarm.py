@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime
+from telegram import Update
+from telegram.ext import ContextTypes
+import api
+import cluster
+import metrics
+from cache import TTLCache
+from storage import token_store
+from config import (
+    RESPONSE_CACHE_SIZE, PREWARM_HOURS, PREWARM_ACTIVE_DAYS, PREWARM_CONCURRENCY, PREWARM_JITTER, PREWARM_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+PREWARM_RESULTS = metrics.Counter('nvbq_prewarm_users_total', 'Результаты фонового прогрева по пользователям', ('result',))
+
+
+class ActivityTracker:
+    """Запоминает время последнего обращения пользователей к боту.
+
+    Обращения копятся в памяти и сбрасываются в базу одной пачкой, чтобы
+    не писать в SQLite на каждое обновление.
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    def touch(self, telegram_id) -> None:
+        self._pending[telegram_id] = time.time()
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        try:
+            await token_store.save_activity(pending)
+        except Exception:
+            # Не теряем обращения, новые отметки важнее старых
+            self._pending = {**pending, **self._pending}
+            raise
+
+
+activity = ActivityTracker()
+# Кого уже прогрели: прогретые данные живут PREWARM_TTL, повторно их не запрашиваем
+_warmed = TTLCache(RESPONSE_CACHE_SIZE, PREWARM_TTL)
+_running = asyncio.Lock()
+
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user is not None:
+        activity.touch(update.effective_user.id)
+
+
+def in_off_peak_window(now: datetime | None = None) -> bool:
+    start, end = PREWARM_HOURS
+    hour = (now or datetime.now()).hour
+    # Окно может переходить через полночь, например (23, 5)
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+async def warm_user(telegram_id, auth_token: str) -> str:
+    """Проверяет токен и загружает в кеш данные личного кабинета.
+
+    Возвращает 'warmed', 'expired' или 'failed'.
+    """
+    # Конфигурацию запрашиваем всегда: это и есть проверка токена
+    response = await api.get_configuration_items(auth_token, force_refresh=True, ttl=PREWARM_TTL)
+    if response.status_code == 401:
+        # Токен истек: удаляем заранее, чтобы пользователь сразу попал на авторизацию, а не на ошибку
+        await token_store.delete_token(telegram_id)
+        api.response_cache.invalidate(auth_token)
+        return 'expired'
+    if response.status_code != 200:
+        return 'failed'
+
+    items = response.json().get('items', [])
+    personal_account_id = items[0].get('personalAccount', {}).get('id') if items else None
+    if not personal_account_id:
+        return 'failed'
+    await token_store.save_personal_account_id(telegram_id, personal_account_id)
+    payments, meters = await asyncio.gather(
+        api.get_payments(auth_token, personal_account_id, force_refresh=True, ttl=PREWARM_TTL),
+        api.get_meters_for_item(auth_token, items[0].get('id'), force_refresh=True, ttl=PREWARM_TTL),
+    )
+    return 'warmed' if payments.status_code == 200 and meters.status_code == 200 else 'failed'
+
+
+async def prewarm_users() -> dict:
+    since = time.time() - PREWARM_ACTIVE_DAYS * 86400
+    # Прогревать больше пользователей, чем помещается в кеш ответов, бессмысленно
+    users = await token_store.active_users(since, RESPONSE_CACHE_SIZE, cluster.shard)
+    semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+    results = {}
+
+    async def warm(telegram_id, auth_token):
+        async with semaphore:
+            # Разносим запросы во времени, чтобы не создавать всплесков нагрузки на domopult
+            await asyncio.sleep(random.uniform(0, PREWARM_JITTER))
+            try:
+                result = await warm_user(telegram_id, auth_token)
+            except api.ApiError as e:
+                logger.warning(f"Не удалось прогреть данные пользователя {telegram_id}: {e}")
+                result = 'failed'
+            if result != 'failed':
+                _warmed.set(telegram_id, True)
+            results[result] = results.get(result, 0) + 1
+            PREWARM_RESULTS.inc(result)
+
+    await asyncio.gather(*(
+        warm(telegram_id, auth_token) for telegram_id, auth_token, _ in users if telegram_id not in _warmed
+    ))
+    return results
+
+
+async def prewarm_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await activity.flush()
+    if not in_off_peak_window() or _running.locked():
+        return
+    async with _running:
+        results = await prewarm_users()
+    if results:
+        logger.info(f"Прогрев кеша завершен: {results}")
@@ -0,0 +1,200 @@
+import time
+from cache import TTLCache
+from config import DB_PATH, READING_HISTORY_MONTHS, READING_ANOMALY_FACTOR
+from storage import SqliteStore
+
+# Тариф 0 - общее показание (вода и сумма по электричеству), 1-3 - тарифы T1-T3
+TARIFF_NAMES = {0: 'общее', 1: 'T1', 2: 'T2', 3: 'T3'}
+METER_TYPES = ('ColdWater', 'HotWater', 'Electricity')
+
+
+def parse_value(value):
+    try:
+        return float(str(value).replace(',', '.').replace(' ', ''))
+    except (TypeError, ValueError):
+        return None
+
+
+def meter_summary(meters_data: list) -> list:
+    # Счётчики из ответа meters/for-item: (id, тип, номер, последнее общее показание)
+    meters = []
+    for item in meters_data:
+        meter = item.get('meter', {})
+        if meter.get('id') is not None and meter.get('type') in METER_TYPES:
+            last_value = parse_value(meter.get('lastValue', {}).get('total', {}).get('displayValue'))
+            meters.append((meter['id'], meter['type'], meter.get('number'), last_value))
+    return meters
+
+
+def parse_batch(text: str, meters: list) -> tuple:
+    """Разбирает показания нескольких счётчиков из одного сообщения.
+
+    Каждая строка - "номер счётчика: показание", для электричества три
+    показания T1, T2, T3 через запятую; счётчики можно пропускать.
+    Общее показание не может быть меньше последнего известного.
+    Возвращает (показания по id счётчика, список ошибок).
+    """
+    by_number = {str(number): (meter_id, meter_type, last_value) for meter_id, meter_type, number, last_value in meters}
+    values, errors = {}, []
+    for line in text.splitlines():
+        number, separator, rest = (part.strip() for part in line.partition(':'))
+        if not number and not rest:
+            continue
+        if not separator or number not in by_number:
+            errors.append(f"неизвестный счётчик: {line.strip()}")
+            continue
+        meter_id, meter_type, last_value = by_number[number]
+        expected = 3 if meter_type == 'Electricity' else 1
+        readings = [reading.strip() for reading in rest.split(',')] if expected > 1 else [rest]
+        if len(readings) != expected or any('.' not in reading or parse_value(reading) is None for reading in readings):
+            errors.append(f"{number}: нужно {'три показания T1, T2, T3 через запятую' if expected > 1 else 'одно показание'} с точкой")
+            continue
+        if last_value is not None and sum(map(parse_value, readings)) < last_value:
+            errors.append(f"{number}: показание меньше последнего ({last_value:g})")
+            continue
+        values[meter_id] = readings
+    return values, errors
+
+
+def _month(timestamp: float) -> str:
+    return time.strftime('%Y-%m', time.localtime(timestamp))
+
+
+class ReadingStore(SqliteStore):
+    """История показаний счётчиков: все полученные от domopult и переданные через бота.
+
+    Одно и то же показание хранится один раз за месяц (ключ - счётчик,
+    тариф, месяц и значение) со временем, когда бот увидел его впервые в
+    этом месяце, поэтому месяц без расхода тоже остается в истории. Для
+    полученных показаний это время получения, а не дата передачи в domopult.
+    """
+
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS meters (
+            meter_id INTEGER PRIMARY KEY,
+            telegram_id INTEGER NOT NULL,
+            meter_type TEXT NOT NULL,
+            number TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS meters_telegram_id ON meters (telegram_id)',
+        '''
+        CREATE TABLE IF NOT EXISTS meter_readings (
+            meter_id INTEGER NOT NULL,
+            tariff INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            value REAL NOT NULL,
+            taken_at REAL NOT NULL,
+            source TEXT NOT NULL,
+            PRIMARY KEY (meter_id, tariff, month, value)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS meter_readings_series ON meter_readings (meter_id, tariff, taken_at)',
+    )
+
+    SAVE_METER_SQL = '''
+        INSERT INTO meters (meter_id, telegram_id, meter_type, number) VALUES (?, ?, ?, ?)
+        ON CONFLICT (meter_id) DO UPDATE SET
+            telegram_id = excluded.telegram_id, meter_type = excluded.meter_type, number = excluded.number
+    '''
+    SAVE_READING_SQL = 'INSERT OR IGNORE INTO meter_readings (meter_id, tariff, month, value, taken_at, source) VALUES (?, ?, ?, ?, ?, ?)'
+    # Последнее показание месяца по каждому ряду, расход в месяц и средний расход
+    # за предыдущие месяцы - одним запросом по всем счётчикам пользователя.
+    # Если между показаниями прошло несколько месяцев (gap), расход делится на них
+    CONSUMPTION_SQL = '''
+        WITH monthly AS (
+            SELECT r.meter_id, r.tariff, m.meter_type, m.number, r.month,
+                   CAST(substr(r.month, 1, 4) AS INTEGER) * 12 + CAST(substr(r.month, 6, 2) AS INTEGER) AS month_index,
+                   MAX(r.value) AS value
+            FROM meters m JOIN meter_readings r ON r.meter_id = m.meter_id
+            WHERE m.telegram_id = ?
+            GROUP BY r.meter_id, r.tariff, r.month
+        ), gaps AS (
+            SELECT *, value - LAG(value) OVER series AS total, month_index - LAG(month_index) OVER series AS gap
+            FROM monthly
+            WINDOW series AS (PARTITION BY meter_id, tariff ORDER BY month)
+        ), deltas AS (
+            SELECT *, total / gap AS delta FROM gaps
+        )
+        SELECT meter_id, tariff, meter_type, number, month, value, delta, gap,
+               AVG(delta) OVER (
+                   PARTITION BY meter_id, tariff ORDER BY month ROWS BETWEEN ? PRECEDING AND 1 PRECEDING
+               ) AS average
+        FROM deltas
+        ORDER BY meter_type, meter_id, tariff, month
+    '''
+
+    def __init__(self, path: str = DB_PATH):
+        super().__init__(path)
+        # Что уже записано: повторно полученные показания и счётчики
+        # не пишутся в базу на каждом открытии личного кабинета
+        self._last_values = TTLCache(50000, ttl=86400)
+        self._meter_owners = TTLCache(50000, ttl=86400)
+
+    async def _save(self, meters: list, readings: list) -> None:
+        # Показание пишется заново только при смене значения или месяца
+        readings = [row for row in readings if self._last_values.get(row[:2]) != row[2:4]]
+        if not meters and not readings:
+            return
+        if meters:
+            await self.executemany(self.SAVE_METER_SQL, meters)
+        if readings:
+            await self.executemany(self.SAVE_READING_SQL, readings)
+            for meter_id, tariff, month, value, _, _ in readings:
+                self._last_values.set((meter_id, tariff), (month, value))
+
+    async def record_fetched(self, telegram_id, meters_data: list) -> None:
+        # meters_data - ответ meters/for-item
+        now = time.time()
+        month = _month(now)
+        meters, readings = [], []
+        for item in meters_data:
+            meter = item.get('meter', {})
+            meter_id, meter_type = meter.get('id'), meter.get('type')
+            if meter_id is None or meter_type not in METER_TYPES:
+                continue
+            if self._meter_owners.get(meter_id) != telegram_id:
+                meters.append((meter_id, telegram_id, meter_type, meter.get('number')))
+                self._meter_owners.set(meter_id, telegram_id)
+            value = parse_value(meter.get('lastValue', {}).get('total', {}).get('displayValue'))
+            if value is not None:
+                readings.append((meter_id, 0, month, value, now, 'fetched'))
+        await self._save(meters, readings)
+
+    async def record_submitted(self, meter_id, values: list) -> None:
+        # Одно значение - общее показание, три - тарифы T1-T3
+        now = time.time()
+        month = _month(now)
+        tariffs = [0] if len(values) == 1 else range(1, len(values) + 1)
+        readings = [
+            (int(meter_id), tariff, month, value, now, 'submitted')
+            for tariff, value in zip(tariffs, map(parse_value, values)) if value is not None
+        ]
+        await self._save([], readings)
+
+    async def consumption(self, telegram_id) -> list:
+        """Ряды расхода по счётчикам пользователя.
+
+        Возвращает список словарей с ключами meter_id, meter_type, number,
+        tariff и months; months - последние READING_HISTORY_MONTHS месяцев
+        в виде кортежей (месяц, показание, расход в месяц, число месяцев с
+        прошлого показания, средний расход, аномалия).
+        """
+        rows = await self.fetchall(self.CONSUMPTION_SQL, (telegram_id, READING_HISTORY_MONTHS))
+        series = {}
+        for meter_id, tariff, meter_type, number, month, value, delta, gap, average in rows:
+            entry = series.get((meter_id, tariff))
+            if entry is None:
+                entry = series[(meter_id, tariff)] = {
+                    'meter_id': meter_id, 'meter_type': meter_type, 'number': number, 'tariff': tariff, 'months': [],
+                }
+            # Аномалия: показание уменьшилось или расход сильно выше среднего за прошлые месяцы
+            anomaly = delta is not None and (delta < 0 or (average is not None and average > 0 and delta > average * READING_ANOMALY_FACTOR))
+            entry['months'].append((month, value, delta, gap, average, anomaly))
+        for entry in series.values():
+            entry['months'] = entry['months'][-READING_HISTORY_MONTHS:]
+        return list(series.values())
+
+
+reading_store = ReadingStore()
@@ -0,0 +1,180 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from contextlib import asynccontextmanager
+import api
+from config import DB_PATH, RECEIPTS_DIR, RECEIPT_SPOOL_SIZE, RECEIPT_MEMORY_BUDGET, RECEIPT_EXPORT_CONCURRENCY
+from storage import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+def is_closed_period(year, month) -> bool:
+    # Квитанции за прошедшие месяцы больше не меняются, их можно кешировать
+    today = datetime.date.today()
+    return (int(year), int(month)) < (today.year, today.month)
+
+
+class ReceiptStore(SqliteStore):
+    """Кеш квитанций: file_id Telegram и копия PDF на диске по хешу содержимого."""
+
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS receipts (
+            personal_account_id TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            file_id TEXT,
+            PRIMARY KEY (personal_account_id, year, month)
+        )
+        ''',
+    )
+
+    GET_SQL = 'SELECT sha256, file_id FROM receipts WHERE personal_account_id = ? AND year = ? AND month = ?'
+    SAVE_SQL = 'INSERT OR REPLACE INTO receipts (personal_account_id, year, month, sha256, file_id) VALUES (?, ?, ?, ?, ?)'
+    SET_FILE_ID_SQL = 'UPDATE receipts SET file_id = ? WHERE personal_account_id = ? AND year = ? AND month = ?'
+
+    def __init__(self, path: str = DB_PATH, directory: str = RECEIPTS_DIR):
+        super().__init__(path)
+        self.directory = directory
+
+    def content_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], f"{sha256}.pdf")
+
+    def _sync_write_content(self, fileobj) -> str:
+        # Копируем файл во временный, попутно считая хеш, и переносим на место
+        os.makedirs(self.directory, exist_ok=True)
+        digest = hashlib.sha256()
+        fileobj.seek(0)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as tmp:
+            for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+                digest.update(chunk)
+                tmp.write(chunk)
+        fileobj.seek(0)
+        sha256 = digest.hexdigest()
+        path = self.content_path(sha256)
+        if os.path.exists(path):
+            os.remove(tmp.name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp.name, path)
+        return sha256
+
+    async def get(self, personal_account_id, year, month):
+        # Возвращает (file_id, путь к копии на диске или None) либо None
+        row = await self.fetchone(self.GET_SQL, (str(personal_account_id), int(year), int(month)))
+        if row is None:
+            return None
+        sha256, file_id = row
+        path = self.content_path(sha256)
+        return file_id, path if os.path.exists(path) else None
+
+    async def save(self, personal_account_id, year, month, fileobj, file_id: str | None = None) -> None:
+        sha256 = await self._run(self._sync_write_content, fileobj)
+        await self.execute(self.SAVE_SQL, (str(personal_account_id), int(year), int(month), sha256, file_id))
+
+    async def set_file_id(self, personal_account_id, year, month, file_id: str) -> None:
+        await self.execute(self.SET_FILE_ID_SQL, (file_id, str(personal_account_id), int(year), int(month)))
+
+
+receipt_store = ReceiptStore()
+
+# Каждое скачивание держит в памяти не больше RECEIPT_SPOOL_SIZE байт (остальное
+# уходит во временный файл), поэтому общий бюджет памяти задает число слотов
+_download_slots = asyncio.Semaphore(max(1, RECEIPT_MEMORY_BUDGET // RECEIPT_SPOOL_SIZE))
+
+
+class _SpooledReceipt(tempfile.SpooledTemporaryFile):
+    # PTB берет имя из атрибута name, а у файла, который еще в памяти, его нет
+    @property
+    def name(self):
+        return super().name or 'receipt.pdf'
+
+
+@asynccontextmanager
+async def download_receipt(auth_token, personal_account_id, year, month):
+    # Отдает (ответ, файл): файл открыт с начала и живет до выхода из блока
+    async with _download_slots:
+        with _SpooledReceipt(max_size=RECEIPT_SPOOL_SIZE) as spool:
+            response = await api.download_receipt(auth_token, personal_account_id, year, month, spool)
+            spool.seek(0)
+            yield response, spool
+
+
+def _sync_copy_to(fileobj, path: str) -> None:
+    fileobj.seek(0)
+    with open(path, 'wb') as target:
+        shutil.copyfileobj(fileobj, target, 1024 * 1024)
+    fileobj.seek(0)
+
+
+def _sync_write_zip(zip_path: str, files: list) -> None:
+    # PDF почти не сжимается, поэтому файлы кладутся в архив без сжатия
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for path, arcname in files:
+            archive.write(path, arcname)
+
+
+async def _fetch_month_to_disk(auth_token, personal_account_id, year, month, directory):
+    # Возвращает путь к PDF за месяц, None для недоступного месяца (400)
+    # или код ответа, если domopult вернул другую ошибку
+    month = f"{month:02d}"
+    if is_closed_period(year, month):
+        cached = await receipt_store.get(personal_account_id, year, month)
+        if cached is not None and cached[1]:
+            return cached[1]
+
+    path = os.path.join(directory, f"{year}-{month}-01.pdf")
+    async with download_receipt(auth_token, personal_account_id, year, month) as (response, receipt_file):
+        if response.status_code == 200:
+            # Запись на диск - в потоке, как и сборка архива, чтобы не занимать цикл событий
+            await asyncio.to_thread(_sync_copy_to, receipt_file, path)
+            if is_closed_period(year, month):
+                await receipt_store.save(personal_account_id, year, month, receipt_file)
+    if response.status_code == 200:
+        return path
+    if response.status_code == 400:
+        return None
+    return response.status_code
+
+
+async def export_year(auth_token, personal_account_id, year, directory: str) -> tuple:
+    """Собирает квитанции за год в один ZIP-архив внутри directory.
+
+    Возвращает (путь к архиву или None, месяцы в архиве, месяцы с ошибкой).
+    Месяцы, за которые квитанции нет, пропускаются.
+    """
+    today = datetime.date.today()
+    last_month = 12 if int(year) < today.year else today.month
+    months = range(1, last_month + 1) if int(year) <= today.year else range(0)
+    semaphore = asyncio.Semaphore(RECEIPT_EXPORT_CONCURRENCY)
+
+    async def fetch(month):
+        async with semaphore:
+            try:
+                return await _fetch_month_to_disk(auth_token, personal_account_id, year, month, directory)
+            except api.ApiError as e:
+                logger.warning(f"Ошибка при получении квитанции за {year}-{month:02d}: {e}")
+                return e
+
+    results = await asyncio.gather(*(fetch(month) for month in months))
+
+    files, included, failed = [], [], []
+    for month, result in zip(months, results):
+        if isinstance(result, str):
+            files.append((result, f"{year}-{month:02d}-01.pdf"))
+            included.append(month)
+        elif result is not None:
+            failed.append(month)
+    if not files:
+        return None, included, failed
+
+    zip_path = os.path.join(directory, f"receipts-{year}.zip")
+    await asyncio.to_thread(_sync_write_zip, zip_path, files)
+    return zip_path, included, failed
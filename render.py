@@ -0,0 +1,71 @@
+import html
+import metrics
+from cache import TTLCache
+from config import RENDER_CACHE_SIZE, RENDER_CACHE_TTL
+
+# Предел длины сообщения Telegram, в UTF-16 символах
+MESSAGE_LIMIT = 4096
+
+# Готовые страницы по (вид отображения, хеш исходного ответа): одинаковые
+# данные не отрисовываются повторно, даже если ответ был получен заново
+render_cache = TTLCache(RENDER_CACHE_SIZE, RENDER_CACHE_TTL)
+metrics.register_cache('render', render_cache)
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+
+def format_number(value) -> str:
+    return f"{value:.3f}".rstrip('0').rstrip('.') if value is not None else '—'
+
+
+def _split_line(line: str, budget: int):
+    # Режем исходную строку, а не экранированную, чтобы не разорвать сущность вроде &amp;
+    escaped = html.escape(line, quote=False)
+    if utf16_len(escaped) <= budget:
+        yield escaped
+        return
+    piece, size = [], 0
+    for char in line:
+        escaped_char = html.escape(char, quote=False)
+        char_size = utf16_len(escaped_char)
+        if size + char_size > budget:
+            yield ''.join(piece)
+            piece, size = [], 0
+        piece.append(escaped_char)
+        size += char_size
+    if piece:
+        yield ''.join(piece)
+
+
+def paginate_pre(text: str, limit: int = MESSAGE_LIMIT) -> tuple:
+    """Разбивает текст на страницы вида <pre>...</pre> не длиннее limit.
+
+    Текст экранируется для parse_mode='HTML', страницы по возможности
+    разрезаются по границам строк.
+    """
+    budget = limit - len('<pre></pre>')
+    pages, current, size = [], [], 0
+    for line in text.strip('\n').split('\n'):
+        for piece in _split_line(line, budget):
+            cost = utf16_len(piece) + (1 if current else 0)
+            if current and size + cost > budget:
+                pages.append('\n'.join(current))
+                current, size, cost = [], 0, utf16_len(piece)
+            current.append(piece)
+            size += cost
+    if current:
+        pages.append('\n'.join(current))
+    return tuple(f'<pre>{page}</pre>' for page in pages) or ('<pre></pre>',)
+
+
+def cached_pages(kind: str, digest: str | None, render) -> tuple:
+    # render() вызывается только при промахе; без хеша кешировать нечего
+    if digest is None:
+        return render()
+    pages = render_cache.get((kind, digest))
+    if pages is None:
+        pages = render()
+        render_cache.set((kind, digest), pages)
+    return pages
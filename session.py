@@ -0,0 +1,124 @@
+import sys
+import time
+from dateutil import parser as dateutil_parser
+
+
+def _intern(value):
+    # Статусы и типы повторяются у всех пользователей, храним по одной копии строки
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _format_date(value):
+    if value:
+        return dateutil_parser.isoparse(value).strftime('%d.%m.%Y %H:%M:%S')
+    return value
+
+
+class Payment:
+    __slots__ = (
+        'id', 'transactional_id', 'creation_date', 'status', 'payment_type', 'service_type',
+        'balance', 'payment_sum', 'payment_insurance', 'payment_sum_without_insurance',
+    )
+
+    def __init__(self, result: dict):
+        self.id = result.get('id')
+        self.transactional_id = result.get('transactionalId')
+        self.creation_date = _format_date(result.get('creationDate'))
+        self.status = _intern(result.get('status'))
+        self.payment_type = _intern(result.get('paymentType'))
+        self.service_type = _intern(result.get('serviceType'))
+        self.balance = result.get('balance')
+        self.payment_sum = result.get('paymentSum')
+        self.payment_insurance = result.get('paymentInsurance')
+        self.payment_sum_without_insurance = result.get('paymentSumWithoutInsurance')
+
+
+class AccountSession:
+    """Данные личного кабинета пользователя, нужные главной странице и подробной информации.
+
+    Собирается из ответа payments сразу при разборе: от полного ответа
+    остаются только используемые поля. Сводка по счету для главной страницы
+    берется из первого платежа, подробности о клиенте и помещении - из
+    последнего.
+    """
+
+    __slots__ = (
+        'loaded_at', 'digest', 'payments',
+        # Главная страница
+        'account_number', 'utilities_balance', 'location',
+        # Подробная информация
+        'account_id', 'account_repairs_balance', 'account_utilities_balance', 'account_number_detail', 'account_is_active',
+        'client_id', 'client_name', 'client_phone', 'client_email', 'client_advertising_mailing',
+        'place_id', 'place_name', 'place_location', 'place_category', 'place_room_type',
+        'place_has_parking', 'place_has_playground', 'place_has_sports_ground', 'place_hot_water', 'place_cold_water',
+        'creation_method', 'login_methods', 'is_debtor', 'service_overall_debt', 'ci_groups',
+    )
+
+    def __init__(self, data: dict, digest: str | None = None):
+        self.loaded_at = time.time()
+        # Хеш исходного ответа, ключ кеша отрисовки
+        self.digest = digest
+        results = data.get('results', [])
+        self.payments = tuple(Payment(result) for result in results)
+
+        first = results[0].get('personalAccount', {}) if results else {}
+        self.account_number = first.get('number', 'Неизвестно')
+        self.utilities_balance = first.get('utilitiesBalance', 'Неизвестно')
+        self.location = first.get('configurationItem', {}).get('address', {}).get('location', '')
+
+        last = results[-1] if results else {}
+        personal_account = last.get('personalAccount', {})
+        self.account_id = personal_account.get('id')
+        self.account_number_detail = personal_account.get('number')
+        self.account_utilities_balance = personal_account.get('utilitiesBalance')
+        self.account_repairs_balance = personal_account.get('repairsBalance')
+        self.account_is_active = bool(personal_account.get('isActive'))
+
+        contact = last.get('client', {}).get('contact', {})
+        self.client_id = last.get('client', {}).get('id')
+        self.client_name = contact.get('name')
+        self.client_phone = contact.get('phone')
+        self.client_email = (contact.get('emails') or [{}])[0].get('email', 'Не указан')
+        self.client_advertising_mailing = contact.get('advertisingMailing')
+
+        place = contact.get('basicConfigurationItem', {})
+        self.place_id = place.get('id')
+        self.place_name = place.get('name')
+        self.place_location = place.get('address', {}).get('location')
+        self.place_category = place.get('category', {}).get('name')
+        self.place_room_type = _intern(place.get('roomType'))
+        self.place_has_parking = bool(place.get('hasParking'))
+        self.place_has_playground = bool(place.get('hasPlayground'))
+        self.place_has_sports_ground = bool(place.get('hasSportsGround'))
+        self.place_hot_water = bool(place.get('meterFlags', {}).get('hotWaterAllowed'))
+        self.place_cold_water = bool(place.get('meterFlags', {}).get('coldWaterAllowed'))
+
+        self.creation_method = _intern(last.get('creationMethod', 'Не указан'))
+        self.login_methods = tuple(_intern(method.get('key')) for method in last.get('loginMethods', []))
+        debtor_info = last.get('debtorInfo', {})
+        self.is_debtor = bool(debtor_info.get('isDebtor', False))
+        self.service_overall_debt = debtor_info.get('serviceOverallDebt')
+        self.ci_groups = tuple(
+            (group.get('id'), group.get('name'), group.get('description'))
+            for group in personal_account.get('configurationItem', {}).get('ciGroups', [])
+        )
+
+
+def evict_idle_sessions(application, key: str, max_age: float) -> int:
+    """Удаляет из user_data сессии, загруженные раньше max_age секунд назад.
+
+    При следующем обращении сессия загрузится заново (обычно из кеша ответов).
+    Возвращает число удаленных сессий.
+    """
+    threshold = time.time() - max_age
+    evicted = []
+    for user_id, user_data in list(application.user_data.items()):
+        session = user_data.get(key)
+        if session is not None and session.loaded_at < threshold:
+            del user_data[key]
+            evicted.append(user_id)
+            if not user_data:
+                application.drop_user_data(user_id)
+    if evicted:
+        application.mark_data_for_update_persistence(user_ids=evicted)
+    return len(evicted)
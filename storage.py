@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from cache import TTLCache
+from config import DB_PATH, DB_BUSY_TIMEOUT, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteStore:
+    """Долгоживущее соединение с SQLite в режиме WAL.
+
+    Все запросы выполняются в отдельном потоке хранилища, поэтому
+    обработчики не блокируют цикл событий, а соединение используется
+    строго из одного потока.
+    """
+
+    SCHEMA = ()
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=type(self).__name__)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, cached_statements=256)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def open(self) -> None:
+        self._executor.submit(self._connect).result()
+
+    def close(self) -> None:
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.submit(_close).result()
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            operation = fn.__name__.removeprefix('_sync_')
+            metrics.SQLITE_LATENCY.observe(type(self).__name__, operation, value=time.perf_counter() - started)
+
+    def _sync_fetchone(self, sql: str, params=()):
+        return self._connect().execute(sql, params).fetchone()
+
+    def _sync_fetchall(self, sql: str, params=()):
+        return self._connect().execute(sql, params).fetchall()
+
+    def _sync_execute(self, sql: str, params=()) -> int:
+        conn = self._connect()
+        with conn:
+            return conn.execute(sql, params).rowcount
+
+    def _sync_executemany(self, sql: str, seq) -> int:
+        conn = self._connect()
+        with conn:
+            return conn.executemany(sql, seq).rowcount
+
+    async def fetchone(self, sql: str, params=()):
+        return await self._run(self._sync_fetchone, sql, params)
+
+    async def fetchall(self, sql: str, params=()):
+        return await self._run(self._sync_fetchall, sql, params)
+
+    async def execute(self, sql: str, params=()) -> int:
+        return await self._run(self._sync_execute, sql, params)
+
+    async def executemany(self, sql: str, seq) -> int:
+        return await self._run(self._sync_executemany, sql, list(seq))
+
+
+class TokenStore(SqliteStore):
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS user_tokens (
+            telegram_id INTEGER PRIMARY KEY,
+            auth_token TEXT NOT NULL,
+            personal_account_id TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_activity (
+            telegram_id INTEGER PRIMARY KEY,
+            last_active REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS user_activity_last_active ON user_activity (last_active)',
+    )
+
+    SAVE_TOKEN_SQL = 'INSERT OR REPLACE INTO user_tokens (telegram_id, auth_token) VALUES (?, ?)'
+    GET_CREDENTIALS_SQL = 'SELECT auth_token, personal_account_id FROM user_tokens WHERE telegram_id = ?'
+    DELETE_TOKEN_SQL = 'DELETE FROM user_tokens WHERE telegram_id = ?'
+    SAVE_PERSONAL_ACCOUNT_ID_SQL = 'UPDATE user_tokens SET personal_account_id = ? WHERE telegram_id = ?'
+    SAVE_ACTIVITY_SQL = '''
+        INSERT INTO user_activity (telegram_id, last_active) VALUES (?, ?)
+        ON CONFLICT (telegram_id) DO UPDATE SET last_active = MAX(last_active, excluded.last_active)
+    '''
+    ACTIVE_USERS_SQL = '''
+        SELECT t.telegram_id, t.auth_token, t.personal_account_id
+        FROM user_activity a JOIN user_tokens t ON t.telegram_id = a.telegram_id
+        WHERE a.last_active >= ? AND t.telegram_id % ? = ?
+        ORDER BY a.last_active DESC
+        LIMIT ?
+    '''
+
+    def __init__(self, path: str = DB_PATH):
+        super().__init__(path)
+        # Кеш учетных данных: telegram_id -> (auth_token, personal_account_id).
+        # Все записи идут сквозь кеш, поэтому он не расходится с таблицей.
+        self.cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+    async def save_token(self, telegram_id, auth_token) -> None:
+        await self.execute(self.SAVE_TOKEN_SQL, (telegram_id, auth_token))
+        # INSERT OR REPLACE сбрасывает personal_account_id
+        self.cache.set(telegram_id, (auth_token, None))
+
+    async def get_credentials(self, telegram_id) -> tuple:
+        # Токен и лицевой счет одним запросом: (auth_token, personal_account_id)
+        credentials = self.cache.get(telegram_id)
+        if credentials is None:
+            row = await self.fetchone(self.GET_CREDENTIALS_SQL, (telegram_id,))
+            credentials = (row[0], row[1]) if row else (None, None)
+            self.cache.set(telegram_id, credentials)
+        return credentials
+
+    async def get_token(self, telegram_id):
+        auth_token, _ = await self.get_credentials(telegram_id)
+        return auth_token
+
+    async def get_personal_account_id(self, telegram_id):
+        _, personal_account_id = await self.get_credentials(telegram_id)
+        return personal_account_id
+
+    async def delete_token(self, telegram_id) -> None:
+        self.cache.pop(telegram_id)
+        await self.execute(self.DELETE_TOKEN_SQL, (telegram_id,))
+        self.cache.set(telegram_id, (None, None))
+
+    async def save_personal_account_id(self, telegram_id, personal_account_id) -> None:
+        # Колонка personal_account_id текстовая, храним в кеше так же, как в таблице
+        personal_account_id = None if personal_account_id is None else str(personal_account_id)
+        auth_token, cached_account_id = await self.get_credentials(telegram_id)
+        if auth_token is None or cached_account_id == personal_account_id:
+            return
+        await self.execute(self.SAVE_PERSONAL_ACCOUNT_ID_SQL, (personal_account_id, telegram_id))
+        self.cache.set(telegram_id, (auth_token, personal_account_id))
+
+    async def save_activity(self, activity: dict) -> None:
+        # activity: telegram_id -> время последнего обращения (unix time)
+        if activity:
+            await self.executemany(self.SAVE_ACTIVITY_SQL, activity.items())
+
+    async def active_users(self, since: float, limit: int, shard: tuple | None = None) -> list:
+        # Авторизованные пользователи, обращавшиеся к боту не раньше since, сначала самые недавние;
+        # shard - (номер, число) процессов-обработчиков, чтобы брать только своих пользователей
+        index, count = shard or (0, 1)
+        return await self.fetchall(self.ACTIVE_USERS_SQL, (since, count, index, limit))
+
+
+token_store = TokenStore()
+metrics.register_cache('token', token_store.cache)
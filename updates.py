@@ -0,0 +1,65 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import metrics
+
+
+def update_owner(update: object):
+    # Обновления одного пользователя должны обрабатываться строго по очереди,
+    # иначе ConversationHandler увидит состояния не в том порядке
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+
+    Обновления одного пользователя выполняются последовательно в порядке
+    поступления. Очередь пользователя ожидается до захвата общего лимита,
+    поэтому один активный пользователь не занимает слоты остальных.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+
+    async def process_update(self, update: object, coroutine) -> None:
+        owner = update_owner(update)
+        if owner is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._locks.get(owner)
+        if entry is None:
+            entry = self._locks[owner] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        metrics.UPDATES_WAITING.inc()
+        waiting = True
+        try:
+            async with entry[0]:
+                metrics.UPDATES_WAITING.dec()
+                waiting = False
+                await super().process_update(update, coroutine)
+        finally:
+            if waiting:
+                metrics.UPDATES_WAITING.dec()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[owner]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        metrics.UPDATES_IN_FLIGHT.inc()
+        try:
+            await coroutine
+        finally:
+            metrics.UPDATES_IN_FLIGHT.dec()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,203 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import random
+import time
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+from telegram.ext import ContextTypes
+import api
+import cluster
+import metrics
+from receipts import receipt_store, download_receipt
+from render import format_number
+from storage import SqliteStore, token_store
+from config import WATCH_INTERVAL, WATCH_BATCH, WATCH_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+WATCH_CHECKS = metrics.Counter('nvbq_watch_checks_total', 'Фоновые проверки изменений в личном кабинете по результату', ('result',))
+
+# Отпечаток - по 4 байта хеша на каждое отслеживаемое поле, в этом порядке
+FIELDS = ('utilities_balance', 'repairs_balance', 'last_payment', 'receipt')
+FIELD_SIZE = 4
+
+
+def fingerprint(values: tuple) -> bytes:
+    return b''.join(hashlib.blake2b(repr(value).encode(), digest_size=FIELD_SIZE).digest() for value in values)
+
+
+def changed_fields(old: bytes, new: bytes) -> list:
+    return [
+        field for position, field in enumerate(FIELDS)
+        if old[position * FIELD_SIZE:(position + 1) * FIELD_SIZE] != new[position * FIELD_SIZE:(position + 1) * FIELD_SIZE]
+    ]
+
+
+class WatchStore(SqliteStore):
+    """Подписки на уведомления об изменениях и отпечатки последнего состояния кабинета.
+
+    Вместо данных кабинета хранится только отпечаток, по которому видно,
+    какие поля изменились. receipt_month - последний месяц с доступной
+    квитанцией, чтобы не проверять ее повторно.
+    """
+
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS watch_subscriptions (
+            telegram_id INTEGER PRIMARY KEY,
+            fingerprint BLOB,
+            receipt_month TEXT,
+            next_check_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS watch_subscriptions_due ON watch_subscriptions (next_check_at)',
+    )
+
+    SUBSCRIBE_SQL = 'INSERT OR IGNORE INTO watch_subscriptions (telegram_id, next_check_at) VALUES (?, ?)'
+    UNSUBSCRIBE_SQL = 'DELETE FROM watch_subscriptions WHERE telegram_id = ?'
+    IS_SUBSCRIBED_SQL = 'SELECT 1 FROM watch_subscriptions WHERE telegram_id = ?'
+    DUE_SQL = '''
+        SELECT telegram_id, fingerprint, receipt_month FROM watch_subscriptions
+        WHERE next_check_at <= ? AND telegram_id % ? = ?
+        ORDER BY next_check_at
+        LIMIT ?
+    '''
+    SAVE_SQL = 'UPDATE watch_subscriptions SET fingerprint = ?, receipt_month = ?, next_check_at = ? WHERE telegram_id = ?'
+    POSTPONE_SQL = 'UPDATE watch_subscriptions SET next_check_at = ? WHERE telegram_id = ?'
+
+    async def subscribe(self, telegram_id) -> None:
+        # Первая проверка сразу: она запоминает текущее состояние, не отправляя уведомления
+        await self.execute(self.SUBSCRIBE_SQL, (telegram_id, time.time()))
+
+    async def unsubscribe(self, telegram_id) -> None:
+        await self.execute(self.UNSUBSCRIBE_SQL, (telegram_id,))
+
+    async def is_subscribed(self, telegram_id) -> bool:
+        return await self.fetchone(self.IS_SUBSCRIBED_SQL, (telegram_id,)) is not None
+
+    async def due(self, limit: int, shard: tuple | None = None) -> list:
+        index, count = shard or (0, 1)
+        return await self.fetchall(self.DUE_SQL, (time.time(), count, index, limit))
+
+    async def save(self, telegram_id, fingerprint: bytes, receipt_month: str | None, next_check_at: float) -> None:
+        await self.execute(self.SAVE_SQL, (fingerprint, receipt_month, next_check_at, telegram_id))
+
+    async def postpone(self, telegram_id, next_check_at: float) -> None:
+        await self.execute(self.POSTPONE_SQL, (next_check_at, telegram_id))
+
+
+watch_store = WatchStore()
+
+_running = asyncio.Lock()
+
+
+def _next_check_at() -> float:
+    # Разброс сохраняет проверки размазанными по интервалу, а не собранными в пики
+    return time.time() + WATCH_INTERVAL * random.uniform(0.9, 1.1)
+
+
+async def _receipt_month(auth_token: str, personal_account_id, known: str | None) -> str | None:
+    # Квитанция за прошлый месяц появляется в начале месяца; найденная уже не проверяется
+    previous = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+    # domopult принимает период только с двузначным месяцем
+    year, month = str(previous.year), f"{previous.month:02d}"
+    period = f"{year}-{month}"
+    if known == period or await receipt_store.get(personal_account_id, year, month) is not None:
+        return period
+    try:
+        async with download_receipt(auth_token, personal_account_id, year, month) as (response, receipt_file):
+            if response.status_code != 200:
+                return known
+            # Прошлый месяц закрыт, квитанция сохраняется и потом отправится без скачивания
+            await receipt_store.save(personal_account_id, year, month, receipt_file)
+    except api.ApiError as e:
+        logger.warning(f"Не удалось проверить квитанцию за {period}: {e}")
+        return known
+    return period
+
+
+def _describe(session, receipt_month: str | None, fields: list) -> str:
+    lines = []
+    if 'utilities_balance' in fields:
+        lines.append(f"💸 Баланс счёта: {session.utilities_balance} ₽")
+    if 'repairs_balance' in fields:
+        lines.append(f"🏗 Баланс капремонта: {session.account_repairs_balance} ₽")
+    if 'last_payment' in fields and session.payments:
+        payment = session.payments[0]
+        lines.append(f"💳 Новый платеж: {payment.creation_date}, {format_number(payment.payment_sum)} ₽")
+    if 'receipt' in fields and receipt_month:
+        year, month = receipt_month.split('-')
+        lines.append(f"📋 Доступна квитанция за {month}.{year}")
+    return "<b>🔔 Изменения в личном кабинете</b>\n" + '\n'.join(lines)
+
+
+async def _notify(bot, telegram_id, text: str, reply_markup=None) -> None:
+    try:
+        await bot.send_message(chat_id=telegram_id, text=text, parse_mode='HTML', reply_markup=reply_markup)
+    except TelegramError as e:
+        logger.warning(f"Не удалось отправить уведомление пользователю {telegram_id}: {e}")
+
+
+async def check_user(bot, telegram_id, old_fingerprint: bytes | None, known_receipt: str | None) -> str:
+    """Сверяет кабинет пользователя с сохраненным отпечатком и сообщает об изменениях.
+
+    Обычно это один запрос payments: баланс и последний платеж берутся из
+    него, квитанция проверяется только пока не найдена за прошлый месяц.
+    """
+    auth_token, personal_account_id = await token_store.get_credentials(telegram_id)
+    if auth_token is None or personal_account_id is None:
+        await watch_store.unsubscribe(telegram_id)
+        return 'unauthorized'
+
+    try:
+        # Свежий ответ заодно обновляет кеш, и следующее открытие кабинета не пойдет в domopult
+        response = await api.get_payments(auth_token, personal_account_id, force_refresh=True)
+        if response.status_code == 401:
+            await watch_store.unsubscribe(telegram_id)
+            await _notify(bot, telegram_id, "<b>🔕 Уведомления отключены.</b>\n└ Авторизация истекла, войдите заново командой /start.")
+            return 'unauthorized'
+        if response.status_code != 200:
+            await watch_store.postpone(telegram_id, _next_check_at())
+            return 'failed'
+        session = response.json()
+        receipt_month = await _receipt_month(auth_token, personal_account_id, known_receipt)
+    except api.ApiError as e:
+        logger.warning(f"Не удалось проверить кабинет пользователя {telegram_id}: {e}")
+        await watch_store.postpone(telegram_id, _next_check_at())
+        return 'failed'
+
+    last_payment = session.payments[0].id if session.payments else None
+    new_fingerprint = fingerprint((session.utilities_balance, session.account_repairs_balance, last_payment, receipt_month))
+    await watch_store.save(telegram_id, new_fingerprint, receipt_month, _next_check_at())
+    if old_fingerprint is None:
+        return 'baseline'
+    fields = changed_fields(old_fingerprint, new_fingerprint)
+    if not fields:
+        return 'unchanged'
+
+    keyboard = [[InlineKeyboardButton("🏠 Личный кабинет", callback_data='start')]]
+    if 'receipt' in fields:
+        keyboard.insert(0, [InlineKeyboardButton("📋 Квитанции", callback_data='download_receipt')])
+    await _notify(bot, telegram_id, _describe(session, receipt_month, fields), InlineKeyboardMarkup(keyboard))
+    return 'changed'
+
+
+async def watch_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if _running.locked():
+        return
+    async with _running:
+        entries = await watch_store.due(WATCH_BATCH, cluster.shard)
+        semaphore = asyncio.Semaphore(WATCH_CONCURRENCY)
+        results = {}
+
+        async def check(entry):
+            async with semaphore:
+                result = await check_user(context.bot, *entry)
+            WATCH_CHECKS.inc(result)
+            results[result] = results.get(result, 0) + 1
+
+        await asyncio.gather(*(check(entry) for entry in entries))
+    if results:
+        logger.info(f"Проверка изменений в кабинетах: {results}")